@@ -0,0 +1,125 @@
+import os
+import glob
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+from keyset import Cursor, SortedIndex
+from records import Coupon
+from stats import DAY
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+HOT_DAYS = max(1, int(os.getenv("ARCHIVE_HOT_DAYS", "90")))
+
+# Decoded segments kept around for paging through old history
+CACHED_SEGMENTS = 2
+
+def month_of(ts: float) -> str:
+    return time.strftime("%Y-%m", time.localtime(ts))
+
+def hot_cutoff(now: float, hot_days: int = HOT_DAYS) -> int:
+    """Start of the month that holds ``now - hot_days``; older redemptions are archived"""
+    start = datetime.fromtimestamp(now - hot_days * DAY).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(start.timestamp())
+
+class UsedArchive:
+    """Redeemed coupons partitioned into monthly gzip-compressed JSON-lines segments.
+
+    Segments are sorted by (redemption time, coupon_id) and rewritten
+    atomically when the store archives another batch into them. Nothing is
+    read at startup: a segment is only decoded when a query reaches back
+    into its month, and the last few decoded segments are cached.
+    """
+
+    def __init__(self, path: str = ARCHIVE_DIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _file(self, month: str) -> str:
+        return os.path.join(self.path, f"used-{month}.jsonl.gz")
+
+    def months(self) -> List[str]:
+        """Return the archived months, oldest first"""
+        files = glob.glob(os.path.join(self.path, "used-*.jsonl.gz"))
+        return sorted(os.path.basename(f)[5:-9] for f in files)
+
+    def _read(self, month: str) -> Iterator[Coupon]:
+        path = self._file(month)
+        if not os.path.exists(path):
+            return
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield Coupon.from_dict(json.loads(line))
+
+    def _segment(self, month: str) -> Tuple[SortedIndex, dict]:
+        """Return the sorted keys and records of a month, decoding it on first use"""
+        with self._lock:
+            seg = self._cache.get(month)
+            if seg is not None:
+                self._cache.move_to_end(month)
+                return seg
+        cpns = {c.coupon_id: c for c in self._read(month)}
+        seg = (SortedIndex(sorted((c.redeemed, c.coupon_id) for c in cpns.values())), cpns)
+        with self._lock:
+            self._cache[month] = seg
+            while len(self._cache) > CACHED_SEGMENTS:
+                self._cache.popitem(last=False)
+        return seg
+
+    def write(self, cpns: list):
+        """Merge redeemed coupons into their monthly segments.
+
+        Records already in a segment are replaced, so archiving the same
+        coupons twice after an interrupted compaction is harmless.
+        """
+        by_month = {}
+        for cpn in cpns:
+            by_month.setdefault(month_of(cpn.redeemed), []).append(cpn)
+        os.makedirs(self.path, exist_ok=True)
+
+        for month, batch in by_month.items():
+            merged = {c.coupon_id: c for c in self._read(month)}
+            merged.update((c.coupon_id, c) for c in batch)
+            path = self._file(month)
+            tmp = f"{path}.tmp"
+            with open(tmp, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                    for cpn in sorted(merged.values(), key=lambda c: (c.redeemed, c.coupon_id)):
+                        gz.write((json.dumps(cpn.to_dict(), ensure_ascii=False) + "\n").encode())
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp, path)
+            with self._lock:
+                self._cache.pop(month, None)
+
+    def iter_used(self) -> Iterator[Coupon]:
+        """Stream every archived coupon, oldest first, one segment at a time"""
+        for month in self.months():
+            yield from self._read(month)
+
+    def page(self, limit: int, cursor: Optional[Cursor] = None, back: bool = False) -> list:
+        """Return up to ``limit`` archived coupons following ``cursor``, newest first.
+
+        Only the segments between the cursor and the end of the page are
+        decoded. ``back`` returns the coupons just newer than the cursor.
+        """
+        months = self.months()
+        if cursor is not None:
+            edge = month_of(cursor[0])
+            months = [m for m in months if (m >= edge if back else m <= edge)]
+        if not back:
+            months.reverse()
+
+        out = []
+        for month in months:
+            if len(out) >= limit:
+                break
+            keys, cpns = self._segment(month)
+            part = [cpns[cid] for _, cid in keys.page(limit - len(out), cursor, back, desc=True)]
+            out = part + out if back else out + part
+        return out
@@ -0,0 +1,354 @@
+"""Benchmarks of the store, rendering, decoding and handler paths as the store grows.
+
+    python bench.py                               # 1k, 10k and 100k coupons
+    python bench.py --sizes 1000,1000000 --backend sqlite
+    python bench.py --save bench_baseline.json
+    python bench.py --compare bench_baseline.json
+
+For every size a synthetic store is written as JSON snapshots into a
+temporary directory and opened with the selected backend (the SQLite one
+imports the snapshots the way it does on a real first start). 30% of the
+coupons are redeemed and half are held by a user. The handlers of bot.py
+are then called directly with stand-ins for Message, FSMContext and Bot,
+so a measurement covers the handler's own work without any network.
+
+Each benchmark reports latency percentiles, throughput and the peak of the
+Python allocations of one extra call (tracemalloc; the render processes are
+not included). ``peak_rss_mb`` is the process high-water mark after a size
+has run. ``--compare`` exits with status 1 when a benchmark's p50 is more
+than ``--threshold`` slower than in the baseline.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("COUPON_SECRET", "bench")
+os.environ.setdefault("WARM_UP", "0")
+
+import bot as app
+import codes
+import decode
+import render
+from records import Coupon, parse_date
+from store import CNTR_FILE, COUPONS_FILE, META_FILE, USED_FILE, JournalStore, dump_json
+from webhook import percentile
+
+ADMIN = int(os.environ["ADMIN_ID"])
+DAY = 86400
+
+# Default iterations per benchmark, before --scale
+ITERATIONS = {
+    "show_stats": 50,
+    "process_recipient_name": 200,
+    "show_used_history": 200,
+    "process_qr": 50,
+    "process_expiry": 10,
+    "create_pdf": 10,
+    "gen_qr": 200,
+    "decode_image": 50
+}
+
+class FakeBot:
+    """Serves photo downloads from the generated corpus"""
+
+    def __init__(self, files: dict):
+        self.files = files
+
+    async def get_file(self, file_id: str):
+        return SimpleNamespace(file_path=file_id)
+
+    async def download_file(self, path: str, dest: io.BytesIO):
+        dest.write(self.files[path])
+
+class FakeMessage:
+    """Just the parts of Message the handlers use; replies are collected"""
+
+    def __init__(self, text: str = None, photo: str = None, user_id: int = ADMIN):
+        self.text = text
+        self.from_user = SimpleNamespace(id=user_id)
+        self.photo = [SimpleNamespace(file_id=photo, file_unique_id=photo)] if photo else None
+        self.media_group_id = None
+        self.replies = []
+
+    async def answer(self, text: str, **kwargs):
+        self.replies.append(text)
+
+    async def answer_document(self, document, **kwargs):
+        self.replies.append(document)
+
+class FakeState:
+    def __init__(self, data: dict):
+        self.data = dict(data)
+
+    async def get_data(self) -> dict:
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+    async def set_state(self, state=None):
+        pass
+
+    async def clear(self):
+        self.data = {}
+
+def expiry_of(serial: int, today: date) -> int:
+    return parse_date((today + timedelta(days=30 + serial % 12 * 30)).strftime("%d.%m.%Y"))
+
+def is_used(serial: int) -> bool:
+    return serial % 10 < 3
+
+def generate(size: int, per_recipient: int, path: str):
+    """Write JSON snapshots of a synthetic store with ``size`` coupons"""
+    rnd = random.Random(size)
+    now = int(time.time())
+    today = date.today()
+    recipients = max(1, size // per_recipient)
+    coupons, used, cntrs = {}, {}, {}
+    for serial in range(1, size + 1):
+        expiry = expiry_of(serial, today)
+        rcpt = f"client{serial % recipients}"
+        uid = 10000 + serial % 5000 if serial % 2 == 0 else None
+        created = now - rnd.randint(61, 120) * DAY
+        cpn = Coupon(codes.mint(serial, expiry), rcpt, expiry, created, None, uid)
+        if is_used(serial):
+            cpn = cpn.redeem(now - rnd.randint(0, 60 * DAY))
+            used[cpn.coupon_id] = cpn.to_dict()
+            cntrs[rcpt] = cntrs.get(rcpt, 0) + 1
+        else:
+            coupons[cpn.coupon_id] = cpn.to_dict()
+
+    dump_json(os.path.join(path, COUPONS_FILE), coupons)
+    dump_json(os.path.join(path, USED_FILE), used)
+    dump_json(os.path.join(path, CNTR_FILE), cntrs)
+    dump_json(os.path.join(path, META_FILE), {"next_serial": size + 1})
+    return recipients
+
+def open_store(backend: str):
+    if backend == "sqlite":
+        from sqlite_store import SqliteStore
+        return SqliteStore()
+    return JournalStore()
+
+def photo_corpus(count: int) -> dict:
+    """Camera-like JPEG photos of active coupon codes, keyed by code"""
+    from PIL import Image, ImageFilter
+
+    rnd = random.Random(0)
+    today = date.today()
+    serials = [s for s in range(1, count * 2 + 1) if not is_used(s)][:count]
+    corpus = {}
+    for serial in serials:
+        code = codes.mint(serial, expiry_of(serial, today))
+        qr = Image.open(io.BytesIO(render.gen_qr(code))).convert("L")
+        qr = qr.resize((420, 420)).rotate(rnd.uniform(-8, 8), expand=True, fillcolor=235)
+        photo = Image.new("L", (1280, 960), 200 + rnd.randint(0, 40))
+        photo.paste(qr, (rnd.randint(100, 700), rnd.randint(50, 400)))
+        photo = photo.filter(ImageFilter.GaussianBlur(1))
+        buf = io.BytesIO()
+        photo.convert("RGB").save(buf, format="JPEG", quality=85)
+        corpus[code] = buf.getvalue()
+    return corpus
+
+async def measure(call, n: int) -> dict:
+    """Time ``n`` calls after one warm-up call, then trace one more for its peak allocation"""
+    await call(-1)
+    lat = []
+    started = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        await call(i)
+        lat.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    await call(n)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    lat.sort()
+    return {
+        "n": n,
+        "p50_ms": round(percentile(lat, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(lat, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(lat, 0.99) * 1000, 3),
+        "ops_per_sec": round(n / elapsed, 1) if elapsed > 0 else 0.0,
+        "peak_alloc_kb": round(peak / 1024, 1)
+    }
+
+def benchmarks(recipients: int, corpus: dict, can_decode: bool) -> tuple:
+    """Return name -> call(i) of every benchmark, and the failure counts they fill in"""
+    photos = list(corpus)
+    samples = list(app.store.iter_active())[:50]
+    expiry_text = (date.today() + timedelta(days=90)).strftime("%d.%m.%Y")
+    failures = {}
+
+    async def show_stats(i):
+        await app.show_stats(FakeMessage("📊 Статистика"))
+
+    async def process_recipient_name(i):
+        await app.process_recipient_name(FakeMessage(f"client{i % recipients}"))
+
+    async def show_used_history(i):
+        await app.show_used_history(FakeMessage("📜 История использованных"))
+
+    async def process_qr(i):
+        # Every call, the warm-up (-1) included, redeems another coupon
+        msg = FakeMessage(photo=photos[i + 1])
+        await app.process_qr(msg)
+        if i >= 0 and not msg.replies[0].startswith("✅"):
+            failures["process_qr"] = failures.get("process_qr", 0) + 1
+
+    async def process_expiry(i):
+        state = FakeState({"count": 10, "recipient": f"client{max(0, i) % recipients}"})
+        await app.process_expiry(FakeMessage(expiry_text), state)
+
+    async def create_pdf(i):
+        render.create_pdf(samples)
+
+    async def gen_qr(i):
+        render.gen_qr(samples[max(0, i) % len(samples)].coupon_id)
+
+    async def decode_image(i):
+        decode.decode_image(corpus[photos[max(0, i) % len(photos)]])
+
+    cases = {
+        "show_stats": show_stats,
+        "process_recipient_name": process_recipient_name,
+        "show_used_history": show_used_history,
+        "process_qr": process_qr,
+        "process_expiry": process_expiry,
+        "create_pdf": create_pdf,
+        "gen_qr": gen_qr,
+        "decode_image": decode_image
+    }
+    if not can_decode:
+        del cases["process_qr"], cases["decode_image"]
+    return cases, failures
+
+async def run_size(size: int, args, corpus: dict, can_decode: bool) -> dict:
+    out = {}
+    with tempfile.TemporaryDirectory(prefix="bench-") as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            started = time.perf_counter()
+            recipients = generate(size, args.per_recipient, path)
+            logging.info(f"Generated {size} coupons in {time.perf_counter() - started:.1f}s")
+
+            started = time.perf_counter()
+            app.store = open_store(args.backend)
+            out["store_open"] = {"n": 1, "seconds": round(time.perf_counter() - started, 3)}
+
+            cases, failures = benchmarks(recipients, corpus, can_decode)
+            for name, call in cases.items():
+                if args.only and name not in args.only:
+                    continue
+                n = max(1, int(ITERATIONS[name] * args.scale))
+                if name == "process_qr":
+                    # One photo each for the warm-up and the traced call
+                    n = min(n, len(corpus) - 2)
+                out[name] = await measure(call, n)
+                if failures.get(name):
+                    out[name]["failed"] = failures[name]
+                print(f"{size:>9} {name:<24} " + " ".join(f"{k}={v}" for k, v in out[name].items()), flush=True)
+            app.store.close()
+        finally:
+            os.chdir(cwd)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    out["peak_rss_mb"] = round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    return out
+
+def revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the benchmarks whose p50 regressed by more than ``threshold``"""
+    regressions = []
+    for size, cases in results.items():
+        for name, cur in cases.items():
+            old = baseline.get(size, {}).get(name)
+            if not isinstance(cur, dict) or not old or "p50_ms" not in cur or "p50_ms" not in old:
+                continue
+            # Below a tenth of a millisecond the timings are mostly noise
+            if cur["p50_ms"] > old["p50_ms"] * (1 + threshold) and cur["p50_ms"] - old["p50_ms"] > 0.1:
+                regressions.append((size, name, old["p50_ms"], cur["p50_ms"]))
+    return regressions
+
+async def main(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    app.bot = FakeBot({})
+    corpus = photo_corpus(args.photos)
+    app.bot.files = corpus
+    try:
+        decode.decode_image(next(iter(corpus.values())))
+        can_decode = True
+    except Exception as e:
+        # e.g. the zbar shared library is missing
+        print(f"Skipping process_qr and decode_image: {str(e)}")
+        can_decode = False
+
+    results = {}
+    try:
+        for size in args.sizes:
+            results[str(size)] = await run_size(size, args, corpus, can_decode)
+    finally:
+        render.shutdown()
+
+    report = {
+        "revision": revision(),
+        "backend": args.backend,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("backend") != args.backend:
+            print(f"Note: the baseline was measured with the {baseline.get('backend')} backend")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for size, name, old, cur in regressions:
+            print(f"REGRESSION {size} {name}: p50 {old} ms -> {cur} ms")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare} (revision {baseline.get('revision') or '?'})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 10000, 100000])
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--per-recipient", type=int, default=100, help="coupons per recipient")
+    parser.add_argument("--photos", type=int, default=60, help="photos in the QR corpus")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the iteration counts")
+    parser.add_argument("--only", type=lambda s: s.split(","), default=None, help="comma-separated benchmarks")
+    parser.add_argument("--save", default=None, help="write the results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="baseline to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p50 slowdown, 0.2 = 20%%")
+    sys.exit(asyncio.run(main(parser.parse_args())))
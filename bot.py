@@ -1,90 +1,117 @@
+import time
+
+# Taken before any other import so the startup report covers them all
+STARTED = time.perf_counter()
+
 import os
+import asyncio
+import hashlib
 import logging
 from datetime import datetime
-from typing import Optional
+from functools import partial
+from typing import Callable, Optional
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
-from aiogram.dispatcher.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters.state import State, StatesGroup
-import qrcode
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-import cv2
-from pyzbar.pyzbar import decode
-import json
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+import codes
+import decode
+import metrics
+import pos
+import render
+from records import ALREADY_USED, EXPIRED, INVALID, NOT_FOUND, REDEEMED, Coupon, RedeemResult
+from fsm_storage import open_storage
+from sender import OutboundSender, broadcast, send_bulk
+from store import LazyStore
+from sweeper import ExpirySweeper
+
+IMPORT_TIME = time.perf_counter() - STARTED
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher()
+# Another Bot API server, e.g. a local one or the fake one of loadgen.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=os.getenv("BOT_TOKEN"), session=session)
+dp = Dispatcher(storage=open_storage())
 
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
+MAX_BATCH = int(os.getenv("MAX_BATCH", "10000"))
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "0.7"))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+EXPIRY_NOTIFY = os.getenv("EXPIRY_NOTIFY", "0") == "1"
+
+# Every outgoing message is paced to Telegram's flood limits, admin replies first
+sender = OutboundSender(urgent_chats=[ADMIN_ID])
+bot.session.middleware(sender)
+
+# Handler latencies and phase timings, served on METRICS_PORT
+timer = metrics.MetricsMiddleware()
+dp.message.middleware(timer)
+dp.callback_query.middleware(timer)
+metrics.register(metrics.Gauge("messages_sent_total", "Messages delivered to Telegram",
+                               lambda: sender.sent, "counter"))
+metrics.register(metrics.Gauge("flood_waits_total", "Messages retried after a flood wait",
+                               lambda: sender.retried, "counter"))
+metrics.register(metrics.Gauge("send_queue", "Messages waiting for the global rate limit",
+                               lambda: sender.report()["queued"]))
+
+# media_group_id -> photo messages of an album still being collected
+albums = {}
+
+# Short key -> recipient, so listing buttons fit in Telegram's 64-byte callback data
+listings = {}
+
+# Strong references to fire-and-forget tasks until they finish
+background = set()
 
 class CouponStates(StatesGroup):
     waiting_for_recipient = State()
     waiting_for_count = State()
     waiting_for_expiry = State()
     waiting_for_delete = State()
+    waiting_for_notify_target = State()
+    waiting_for_notify_text = State()
+
+# Snapshots are read on first use or by the warm-up, not before polling starts
+store = LazyStore()
+
+async def notify_expired(cpns: list):
+    """Tell holders which of their coupons just expired, in the background"""
+    by_user = {}
+    for cpn in cpns:
+        if cpn.user_id is not None:
+            by_user.setdefault(cpn.user_id, []).append(cpn)
+    if not by_user:
+        return
+
+    messages = {
+        uid: "⏰ Срок действия ваших купонов истек:\n\n" + "\n".join(
+            f"🆔 {cpn.coupon_id} (до {cpn.expiry_date})" for cpn in usr_cpns
+        )
+        for uid, usr_cpns in by_user.items()
+    }
+    task = asyncio.create_task(send_bulk(bot, messages))
+    background.add(task)
+    task.add_done_callback(background.discard)
 
-COUPONS_FILE = "coupons.json"
-USED_FILE = "used_coupons.json"
-CNTR_FILE = "counters.json"
+async def on_expired(cpns: list):
+    """Drop the cached PDFs of expired coupons and optionally tell their holders"""
+    render.cache.evict(c.coupon_id for c in cpns)
+    if EXPIRY_NOTIFY:
+        await notify_expired(cpns)
 
-def load_coupons() -> dict:
-    """Load coupons from JSON file"""
-    if os.path.exists(COUPONS_FILE):
-        try:
-            with open(COUPONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-    return {}
-
-def load_used() -> dict:
-    """Load used coupons from JSON file"""
-    if os.path.exists(USED_FILE):
-        try:
-            with open(USED_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-    return {}
-
-def load_cntrs() -> dict:
-    """Load counters from JSON file"""
-    if os.path.exists(CNTR_FILE):
-        try:
-            with open(CNTR_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-    return {}
-
-def save_coupons(coupons: dict):
-    """Save coupons to JSON file"""
-    with open(COUPONS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(coupons, f, ensure_ascii=False, indent=4)
-
-def save_used(used: dict):
-    """Save used coupons to JSON file"""
-    with open(USED_FILE, 'w', encoding='utf-8') as f:
-        json.dump(used, f, ensure_ascii=False, indent=4)
-
-def save_cntrs(cntrs: dict):
-    """Save counters to JSON file"""
-    with open(CNTR_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cntrs, f, ensure_ascii=False, indent=4)
-
-coupons = load_coupons()
-used = load_used()
-cntrs = load_cntrs()
+# Moves coupons out of the active set as they expire
+sweeper = ExpirySweeper(store, on_expired)
 
 def get_admin_kb() -> ReplyKeyboardMarkup:
     """Create admin keyboard"""
@@ -92,7 +119,8 @@ def get_admin_kb() -> ReplyKeyboardMarkup:
         keyboard=[
             [KeyboardButton(text="📝 Создать купон"), KeyboardButton(text="📊 Статистика")],
             [KeyboardButton(text="📋 Список купонов"), KeyboardButton(text="🔍 Сканировать QR")],
-            [KeyboardButton(text="📜 История использованных"), KeyboardButton(text="🗑 Удалить купон")]
+            [KeyboardButton(text="📜 История использованных"), KeyboardButton(text="🗑 Удалить купон")],
+            [KeyboardButton(text="📣 Рассылка")]
         ],
         resize_keyboard=True
     )
@@ -108,69 +136,45 @@ def get_user_kb() -> ReplyKeyboardMarkup:
     )
     return kb
 
-def gen_coupon_id() -> str:
-    """Generate a unique coupon ID"""
-    import random
-    import string
-    chars = string.ascii_uppercase + string.digits
-    return f"PROMO-{''.join(random.choices(chars, k=6))}"
-
-def gen_qr(cid: str) -> str:
-    """Generate QR code for coupon and return path to saved image"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(cid)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    fname = f"qr_{cid}.png"
-    img.save(fname)
-    return fname
-
-def create_pdf(coupons: list) -> str:
-    """Create PDF with multiple coupons"""
-    fname = f"coupons_{coupons[0]['recipient']}.pdf"
-    c = canvas.Canvas(fname, pagesize=A4)
-    w, h = A4
-
-    for i, cpn in enumerate(coupons):
-        c.setFillColorRGB(0.95, 0.95, 0.95)
-        c.rect(0, 0, w, h, fill=True)
-
-        c.setStrokeColorRGB(0.2, 0.2, 0.2)
-        c.setLineWidth(2)
-        c.rect(20*mm, 20*mm, w - 40*mm, h - 40*mm)
-
-        c.setFillColorRGB(0.2, 0.2, 0.2)
-        c.setFont("Helvetica-Bold", 32)
-        c.drawCentredString(w/2, h - 60*mm, "КУПОН")
-
-        c.setFont("Helvetica-Bold", 20)
-        c.drawCentredString(w/2, h - 90*mm, f"Для: {cpn['recipient']}")
-
-        c.setFont("Helvetica-Bold", 18)
-        c.drawCentredString(w/2, h - 120*mm, f"Купон #{i+1} из {len(coupons)}")
-
-        c.setFont("Helvetica-Bold", 18)
-        c.drawCentredString(w/2, h - 150*mm, f"Код: {cpn['coupon_id']}")
-
-        c.setFont("Helvetica", 16)
-        c.drawCentredString(w/2, h - 180*mm, f"Действует до: {cpn['expiry_date']}")
-
-        qr_path = gen_qr(cpn["coupon_id"])
-        c.drawImage(qr_path, w/2 - 35*mm, h - 260*mm, width=70*mm, height=70*mm)
-        os.remove(qr_path)
-
-        c.setFont("Helvetica", 12)
-        c.drawCentredString(w/2, 40*mm, "Покажите этот купон при оплате")
-        c.drawCentredString(w/2, 30*mm, "Одноразовое использование")
-
-        c.setFont("Helvetica", 10)
-        c.drawCentredString(w/2, 20*mm, f"Страница {i+1} из {len(coupons)}")
-
-        if i < len(coupons) - 1:
-            c.showPage()
-
-    c.save()
-    return fname
+def load_page(fetch: Callable, cursor: Optional[tuple], back: bool) -> tuple:
+    """Fetch one keyset page, returning (items, has_prev, has_next).
+
+    One extra row is requested to tell whether another page follows in the
+    direction of travel. If the rows around the cursor are gone, the view
+    falls back to the first page.
+    """
+    items = fetch(PAGE_SIZE + 1, cursor, back)
+    more = len(items) > PAGE_SIZE
+    if back:
+        items = items[-PAGE_SIZE:]
+        if items:
+            return items, more, True
+    elif items:
+        return items[:PAGE_SIZE], cursor is not None, more
+    if cursor is None:
+        return [], False, False
+    return load_page(fetch, None, False)
+
+def page_kb(prefix: str, items: list, key: Callable, has_prev: bool, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    """Create prev/next buttons carrying the cursor of the first / last shown item"""
+    row = []
+    if has_prev:
+        ts, cid = key(items[0])
+        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}:b:{ts}:{cid}"))
+    if has_next:
+        ts, cid = key(items[-1])
+        row.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"{prefix}:f:{ts}:{cid}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row]) if row else None
+
+def parse_cursor(direction: str, ts: str, cid: str) -> tuple:
+    """Decode the cursor part of a page button into (cursor, back)"""
+    return (int(ts), cid), direction == "b"
+
+def created_key(cpn: Coupon) -> tuple:
+    return cpn.created, cpn.coupon_id
+
+def used_key(cpn: Coupon) -> tuple:
+    return cpn.redeemed, cpn.coupon_id
 
 @dp.message(Command("start"))
 async def cmd_start(msg: Message):
@@ -203,21 +207,21 @@ async def process_recipient(msg: Message, state: FSMContext):
     """Process recipient name and ask for coupon count"""
     await state.update_data(recipient=msg.text)
     await state.set_state(CouponStates.waiting_for_count)
-    await msg.answer("Введите количество купонов для генерации (от 1 до 10):")
+    await msg.answer(f"Введите количество купонов для генерации (от 1 до {MAX_BATCH}):")
 
 @dp.message(CouponStates.waiting_for_count)
 async def process_count(msg: Message, state: FSMContext):
     """Process coupon count and ask for expiry date"""
     try:
         cnt = int(msg.text)
-        if cnt < 1 or cnt > 10:
-            await msg.answer("❌ Количество должно быть от 1 до 10. Попробуйте снова:")
+        if cnt < 1 or cnt > MAX_BATCH:
+            await msg.answer(f"❌ Количество должно быть от 1 до {MAX_BATCH}. Попробуйте снова:")
             return
         await state.update_data(count=cnt)
         await state.set_state(CouponStates.waiting_for_expiry)
         await msg.answer("Введите дату окончания действия (ДД.ММ.ГГГГ):")
     except ValueError:
-        await msg.answer("❌ Пожалуйста, введите число от 1 до 10:")
+        await msg.answer(f"❌ Пожалуйста, введите число от 1 до {MAX_BATCH}:")
 
 @dp.message(CouponStates.waiting_for_expiry)
 async def process_expiry(msg: Message, state: FSMContext):
@@ -228,25 +232,23 @@ async def process_expiry(msg: Message, state: FSMContext):
             await msg.answer("❌ Дата окончания не может быть в прошлом. Попробуйте снова:")
             return
 
+        expiry = int(exp_date.timestamp())
+        if not codes.signable(expiry):
+            await msg.answer(
+                f"❌ Дата окончания не может быть позже {codes.LAST_EXPIRY.strftime('%d.%m.%Y')}. Попробуйте снова:"
+            )
+            return
+
         data = await state.get_data()
         cnt = data["count"]
         rcpt = data["recipient"]
 
-        cpn_data = []
-        for i in range(cnt):
-            cid = gen_coupon_id()
-            cpn = {
-                "coupon_id": cid,
-                "recipient": rcpt,
-                "expiry_date": msg.text,
-                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "used": False
-            }
-            cpn_data.append(cpn)
-            coupons[cid] = cpn
-            save_coupons(coupons)
-
-        pdf_path = create_pdf(cpn_data)
+        created = int(time.time())
+        start = store.reserve_serials(cnt)
+        cpn_data = [Coupon(codes.mint(start + i, expiry), rcpt, expiry, created) for i in range(cnt)]
+
+        with metrics.phase("store_commit"):
+            store.add(cpn_data)
 
         await msg.answer(
             f"✅ Создано {cnt} купонов для {rcpt}!\n\n"
@@ -255,9 +257,20 @@ async def process_expiry(msg: Message, state: FSMContext):
             "⚠️ Покажите PDF-файл с QR-кодом при использовании\n"
             "🔁 Одноразовые купоны"
         )
-        await msg.answer_document(types.FSInputFile(pdf_path))
 
-        os.remove(pdf_path)
+        started = time.perf_counter()
+        files = 0
+        async for fname, pdf in render.render_chunks(cpn_data):
+            await msg.answer_document(types.BufferedInputFile(pdf, filename=fname))
+            files += 1
+        pps = cnt / (time.perf_counter() - started)
+        logging.info(f"Rendered {cnt} coupon pages for {rcpt} in {files} file(s) at {pps:.1f} pages/s")
+
+        if files > 1:
+            await msg.answer(
+                f"📄 Купоны разбиты на {files} PDF-файлов\n"
+                f"⚡ Скорость генерации: {pps:.1f} стр/с"
+            )
         await state.clear()
 
     except ValueError:
@@ -270,27 +283,11 @@ async def show_stats(msg: Message):
         await msg.answer("⛔️ У вас нет доступа к этой функции.")
         return
 
-    total = len(coupons)
-    used_cnt = sum(1 for c in coupons.values() if c["used"])
-    active = sum(1 for c in coupons.values() if not c["used"])
-    expired = sum(
-        1
-        for c in coupons.values()
-        if datetime.strptime(c["expiry_date"], "%d.%m.%Y") < datetime.now()
-    )
-
-    usr_stats = {}
-    for cpn in coupons.values():
-        rcpt = cpn["recipient"]
-        if rcpt not in usr_stats:
-            usr_stats[rcpt] = {"active": 0, "used": 0, "expired": 0}
-
-        if cpn["used"]:
-            usr_stats[rcpt]["used"] += 1
-        elif datetime.strptime(cpn["expiry_date"], "%d.%m.%Y") < datetime.now():
-            usr_stats[rcpt]["expired"] += 1
-        else:
-            usr_stats[rcpt]["active"] += 1
+    totals, usr_stats, last_24h = store.stats.report(time.time())
+    active = totals["active"]
+    used_cnt = totals["used"]
+    expired = totals["expired"]
+    total = active + used_cnt + expired
 
     stats = (
         "📊 Детальная статистика купонов:\n\n"
@@ -311,17 +308,68 @@ async def show_stats(msg: Message):
             f"   ⏰ Истекших: {data['expired']}\n"
         )
 
-    last_24h = sum(
-        1
-        for c in used.values()
-        if (datetime.now() - datetime.strptime(c["used_at"], "%Y-%m-%d %H:%M:%S")).total_seconds()
-        < 86400
-    )
-
     stats += f"\n📈 Использовано за последние 24 часа: {last_24h}"
 
     await msg.answer(stats)
 
+@dp.message(lambda msg: msg.text == "📣 Рассылка")
+async def notify_btn(msg: Message, state: FSMContext):
+    """Ask whom to notify"""
+    if msg.from_user.id != ADMIN_ID:
+        await msg.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    await state.set_state(CouponStates.waiting_for_notify_target)
+    await msg.answer(
+        "👥 Введите имя получателя, чтобы уведомить владельцев его активных купонов,\n"
+        "или ID пользователей через запятую:"
+    )
+
+@dp.message(CouponStates.waiting_for_notify_target)
+async def process_notify_target(msg: Message, state: FSMContext):
+    """Resolve the notification target to chat ids"""
+    parts = [p.strip() for p in (msg.text or "").split(",")]
+    if all(p.isdigit() for p in parts):
+        chat_ids = {int(p) for p in parts}
+    else:
+        chat_ids = store.holders(msg.text)
+
+    if not chat_ids:
+        await msg.answer(f"📭 Нет пользователей с активными купонами {msg.text}.", reply_markup=get_admin_kb())
+        await state.clear()
+        return
+
+    await state.update_data(notify_chats=sorted(chat_ids))
+    await state.set_state(CouponStates.waiting_for_notify_text)
+    await msg.answer(f"👥 Получателей: {len(chat_ids)}\n\nВведите текст уведомления:")
+
+async def run_broadcast(chat_ids: list, text: str):
+    """Send a notification and report the outcome to the admin"""
+    started = time.perf_counter()
+    delivered, failed = await broadcast(bot, chat_ids, text)
+    logging.info(f"Broadcast to {len(chat_ids)} chats took {time.perf_counter() - started:.1f}s: {sender.report()}")
+    await bot.send_message(
+        ADMIN_ID,
+        f"📣 Рассылка завершена\n✅ Доставлено: {delivered}\n❌ Не доставлено: {failed}"
+    )
+
+@dp.message(CouponStates.waiting_for_notify_text)
+async def process_notify_text(msg: Message, state: FSMContext):
+    """Start sending the notification in the background"""
+    if not msg.text:
+        await msg.answer("❌ Введите текст уведомления:")
+        return
+
+    data = await state.get_data()
+    await state.clear()
+    chat_ids = data["notify_chats"]
+
+    # Sending to many users takes a while at Telegram's rate limits
+    task = asyncio.create_task(run_broadcast(chat_ids, msg.text))
+    background.add(task)
+    task.add_done_callback(background.discard)
+    await msg.answer(f"📣 Рассылка запущена для {len(chat_ids)} пользователей.", reply_markup=get_admin_kb())
+
 @dp.message(lambda msg: msg.text == "📋 Список купонов")
 async def list_coupons_btn(msg: Message, state: FSMContext):
     """Handle list coupons button"""
@@ -331,44 +379,92 @@ async def list_coupons_btn(msg: Message, state: FSMContext):
 
     await msg.answer("👤 Введите имя получателя для просмотра купонов:")
 
-@dp.message(lambda msg: msg.text and msg.from_user.id == ADMIN_ID)
-async def process_recipient_name(msg: Message):
-    """Process recipient name for coupon listing"""
-    rcpt = msg.text
-    active = [c for c in coupons.values() if c["recipient"] == rcpt]
-    used_cpns = [c for c in used.values() if c["recipient"] == rcpt]
-
-    used_cnt = cntrs.get(rcpt, 0)
+def listing_key(rcpt: str) -> str:
+    key = hashlib.blake2s(rcpt.encode(), digest_size=6).hexdigest()
+    listings[key] = rcpt
+    return key
 
-    if not active and not used_cpns:
-        await msg.answer(
-            f"📭 Купоны для {rcpt} не найдены.",
-            reply_markup=get_admin_kb()
-        )
-        return
+def recipient_page(rcpt: str, active: list, has_prev: bool, has_next: bool) -> tuple:
+    """Build the text and buttons of one page of a recipient listing"""
+    active_cnt = store.active_count(rcpt)
+    used_cpns = store.used_by_recipient(rcpt, limit=5)
+    used_cnt = store.used_count(rcpt)
 
     resp = f"📋 Купоны для {rcpt}:\n\n"
 
     if active:
-        exp_date = active[0]["expiry_date"]
+        exp_date = active[0].expiry_date
         resp += (
-            f"✅ Активные купоны: {len(active)}\n"
+            f"✅ Активные купоны: {active_cnt}\n"
             f"📅 Срок действия: до {exp_date}\n\n"
         )
         for cpn in active:
-            resp += f"🆔 {cpn['coupon_id']}\n"
+            resp += f"🆔 {cpn.coupon_id}\n"
         resp += "\n"
 
     resp += f"❌ Всего использовано купонов: {used_cnt}\n"
     if used_cpns:
         resp += f"📜 Последние использованные:\n"
-        for cpn in used_cpns[-5:]:
+        for cpn in used_cpns:
             resp += (
-                f"🆔 {cpn['coupon_id']}\n"
-                f"📅 Использован: {cpn['used_at']}\n"
+                f"🆔 {cpn.coupon_id}\n"
+                f"📅 Использован: {cpn.used_at}\n"
             )
 
-    await msg.answer(resp, reply_markup=get_admin_kb())
+    key = listing_key(rcpt)
+    kb = page_kb(f"rcpt:{key}", active, created_key, has_prev, has_next)
+    if active:
+        rows = kb.inline_keyboard if kb else []
+        rows.append([InlineKeyboardButton(text="📄 Отправить PDF снова", callback_data=f"pdf:r:{key}")])
+        kb = InlineKeyboardMarkup(inline_keyboard=rows)
+    return resp, kb
+
+@dp.message(lambda msg: msg.text and msg.from_user.id == ADMIN_ID)
+async def process_recipient_name(msg: Message):
+    """Process recipient name for coupon listing"""
+    rcpt = msg.text
+    active, has_prev, has_next = load_page(partial(store.active_page, rcpt), None, False)
+
+    if not active and not store.used_count(rcpt):
+        await msg.answer(
+            f"📭 Купоны для {rcpt} не найдены.",
+            reply_markup=get_admin_kb()
+        )
+        return
+
+    resp, kb = recipient_page(rcpt, active, has_prev, has_next)
+    await msg.answer(resp, reply_markup=kb or get_admin_kb())
+
+@dp.callback_query(lambda cb: cb.data and cb.data.startswith("rcpt:"))
+async def recipient_page_btn(cb: types.CallbackQuery):
+    """Show another page of a recipient listing"""
+    if cb.from_user.id != ADMIN_ID:
+        await cb.answer("⛔️ У вас нет доступа к этой функции.", show_alert=True)
+        return
+
+    _, key, *rest = cb.data.split(":", 4)
+    rcpt = listings.get(key)
+    if rcpt is None:
+        await cb.answer("⌛ Список устарел, запросите его снова.", show_alert=True)
+        return
+
+    cursor, back = parse_cursor(*rest)
+    active, has_prev, has_next = load_page(partial(store.active_page, rcpt), cursor, back)
+    resp, kb = recipient_page(rcpt, active, has_prev, has_next)
+    await cb.message.edit_text(resp, reply_markup=kb)
+    await cb.answer()
+
+def history_page(cpns: list) -> str:
+    """Build one page of the used coupon history, newest first"""
+    resp = "📜 История использованных купонов:\n\n"
+    for cpn in cpns:
+        resp += (
+            f"👤 {cpn.recipient}\n"
+            f"🆔 {cpn.coupon_id}\n"
+            f"📅 Использован: {cpn.used_at}\n"
+            f"📅 Срок действия был до: {cpn.expiry_date}\n\n"
+        )
+    return resp
 
 @dp.message(lambda msg: msg.text == "📜 История использованных")
 async def show_used_history(msg: Message):
@@ -377,27 +473,24 @@ async def show_used_history(msg: Message):
         await msg.answer("⛔️ У вас нет доступа к этой функции.")
         return
 
-    if not used:
+    cpns, has_prev, has_next = load_page(store.used_page, None, False)
+    if not cpns:
         await msg.answer("📭 История использованных купонов пуста.")
         return
 
-    rcpts = {}
-    for cpn in used.values():
-        if cpn["recipient"] not in rcpts:
-            rcpts[cpn["recipient"]] = []
-        rcpts[cpn["recipient"]].append(cpn)
+    await msg.answer(history_page(cpns), reply_markup=page_kb("hist", cpns, used_key, has_prev, has_next))
 
-    resp = "📜 История использованных купонов:\n\n"
-    for rcpt, cpns in rcpts.items():
-        resp += f"👤 {rcpt}:\n"
-        for cpn in cpns:
-            resp += (
-                f"🆔 {cpn['coupon_id']}\n"
-                f"📅 Использован: {cpn['used_at']}\n"
-                f"📅 Срок действия был до: {cpn['expiry_date']}\n\n"
-            )
+@dp.callback_query(lambda cb: cb.data and cb.data.startswith("hist:"))
+async def used_history_page_btn(cb: types.CallbackQuery):
+    """Show another page of the used coupon history"""
+    if cb.from_user.id != ADMIN_ID:
+        await cb.answer("⛔️ У вас нет доступа к этой функции.", show_alert=True)
+        return
 
-    await msg.answer(resp)
+    cursor, back = parse_cursor(*cb.data.split(":", 3)[1:])
+    cpns, has_prev, has_next = load_page(store.used_page, cursor, back)
+    await cb.message.edit_text(history_page(cpns), reply_markup=page_kb("hist", cpns, used_key, has_prev, has_next))
+    await cb.answer()
 
 @dp.message(lambda msg: msg.text == "🔍 Сканировать QR")
 async def scan_qr_btn(msg: Message):
@@ -414,28 +507,113 @@ async def scan_qr_btn(msg: Message):
         "• QR-код должен занимать большую часть кадра"
     )
 
+async def answer_redeem(msg: Message, res: RedeemResult):
+    """Reply with the detailed outcome of redeeming a single coupon"""
+    cpn = res.coupon
+
+    if res.status == INVALID:
+        await msg.answer("❌ Недействительный код купона. QR-код подделан или поврежден.")
+        return
+
+    if res.status == NOT_FOUND:
+        await msg.answer(
+            "❌ Купон не найден в базе данных.\n\n"
+            "Возможные причины:\n"
+            "• Купон уже использован\n"
+            "• Купон был удален\n"
+            "• QR-код поврежден"
+        )
+        return
+
+    if res.status == EXPIRED and cpn is None:
+        await msg.answer("❌ Срок действия купона истек.")
+        return
+
+    if res.status == EXPIRED:
+        await msg.answer(
+            f"❌ Срок действия купона истек.\n\n"
+            f"👤 Получатель: {cpn.recipient}\n"
+            f"📅 Срок действия был до: {cpn.expiry_date}"
+        )
+        return
+
+    if res.status == ALREADY_USED:
+        await msg.answer(
+            "❌ Этот купон уже был использован.\n\n"
+            f"👤 Получатель: {cpn.recipient}\n"
+            f"🆔 ID: {cpn.coupon_id}\n"
+            f"📅 Действует до: {cpn.expiry_date}\n"
+            f"⏰ Использован: {cpn.used_at}"
+        )
+        return
+
+    await msg.answer(
+        f"✅ Купон успешно активирован!\n\n"
+        f"👤 Получатель: {cpn.recipient}\n"
+        f"🆔 ID: {cpn.coupon_id}\n"
+        f"📅 Действует до: {cpn.expiry_date}\n"
+        f"⏰ Использован: {cpn.used_at}\n"
+        f"📊 Всего использовано купонов: {res.count}\n\n"
+        "✅ Купон помечен как использованный и удален из базы.",
+        reply_markup=get_admin_kb()
+    )
+
+    logging.info(f"Coupon {cpn.coupon_id} used by {cpn.recipient} at {cpn.used_at}")
+
+def batch_summary(scanned: list, results: dict, unreadable: int) -> str:
+    """Build one per-code reply for a batch of scanned codes"""
+    ok = 0
+    resp = f"🧾 Результат сканирования ({len(scanned)} кодов):\n\n"
+    for code in scanned:
+        res = results.get(code)
+        if res is None:
+            resp += f"⚠️ {code} — не купон\n"
+        elif res.status == INVALID:
+            resp += f"🚫 {code} — недействительный код\n"
+        elif res.status == REDEEMED:
+            ok += 1
+            resp += f"✅ {code} — {res.coupon.recipient}\n"
+        elif res.status == ALREADY_USED:
+            resp += f"❌ {code} — уже использован {res.coupon.used_at}\n"
+        elif res.status == EXPIRED:
+            resp += f"⏰ {code} — истек\n"
+        else:
+            resp += f"❓ {code} — не найден\n"
+
+    resp += f"\n✅ Активировано: {ok} из {len(scanned)}"
+    if unreadable:
+        resp += f"\n⚠️ Не удалось прочитать фото: {unreadable}"
+    return resp
+
 @dp.message(lambda msg: msg.photo is not None)
 async def process_qr(msg: Message):
-    """Process QR code from photo"""
+    """Redeem every QR code found in a photo or in a whole album"""
     if msg.from_user.id != ADMIN_ID:
         await msg.answer("⛔️ Только администратор может сканировать QR-коды.")
         return
 
+    photos = [msg]
+    if msg.media_group_id is not None:
+        # Album photos arrive as separate updates; the first one collects the rest
+        group = albums.setdefault(msg.media_group_id, [])
+        group.append(msg)
+        if len(group) > 1:
+            return
+        await asyncio.sleep(ALBUM_WAIT)
+        photos = albums.pop(msg.media_group_id)
+
     try:
-        file = await bot.get_file(msg.photo[-1].file_id)
-        fpath = f"temp_{msg.message_id}.jpg"
-        await bot.download_file(file.file_path, fpath)
+        decoded = await asyncio.gather(*(
+            decode.decode_photo(bot, m.photo[-1].file_id, m.photo[-1].file_unique_id) for m in photos
+        ))
+        unreadable = sum(1 for d in decoded if d is None)
+        scanned = list(dict.fromkeys(c for d in decoded if d for c in d))
 
-        img = cv2.imread(fpath)
-        if img is None:
+        if not scanned and unreadable == len(photos):
             await msg.answer("❌ Ошибка при чтении изображения. Попробуйте еще раз.")
             return
 
-        decoded = decode(img)
-
-        os.remove(fpath)
-
-        if not decoded:
+        if not scanned:
             await msg.answer(
                 "❌ QR-код не найден на изображении.\n\n"
                 "Возможные причины:\n"
@@ -446,67 +624,25 @@ async def process_qr(msg: Message):
             )
             return
 
-        cid = decoded[0].data.decode()
-
-        if not cid.startswith("PROMO-"):
-            await msg.answer("❌ Неверный формат QR-кода. Это не купон.")
-            return
-
-        if cid not in coupons:
-            await msg.answer(
-                "❌ Купон не найден в базе данных.\n\n"
-                "Возможные причины:\n"
-                "• Купон уже использован\n"
-                "• Купон был удален\n"
-                "• QR-код поврежден"
-            )
-            return
-
-        cpn = coupons[cid]
-        exp_date = datetime.strptime(cpn["expiry_date"], "%d.%m.%Y")
-
-        if exp_date < datetime.now():
-            await msg.answer(
-                f"❌ Срок действия купона истек.\n\n"
-                f"👤 Получатель: {cpn['recipient']}\n"
-                f"📅 Срок действия был до: {cpn['expiry_date']}"
-            )
-            return
-
-        if cpn["used"]:
-            await msg.answer(
-                "❌ Этот купон уже был использован.\n\n"
-                f"👤 Получатель: {cpn['recipient']}\n"
-                f"🆔 ID: {cpn['coupon_id']}\n"
-                f"📅 Действует до: {cpn['expiry_date']}"
-            )
+        now = int(time.time())
+        cids = [c for c in scanned if c.startswith(codes.PREFIX)]
+        results, lookup = codes.precheck(cids, now)
+        with metrics.phase("store_commit"):
+            results.update(zip(lookup, store.redeem_many(lookup, now)))
+        render.cache.evict(cid for cid, r in results.items() if r.status == REDEEMED)
+
+        if len(scanned) == 1 and not unreadable:
+            if not cids:
+                await msg.answer("❌ Неверный формат QR-кода. Это не купон.")
+                return
+            await answer_redeem(msg, results[cids[0]])
             return
-        rcpt = cpn["recipient"]
-        cntrs[rcpt] = cntrs.get(rcpt, 0) + 1
-        save_cntrs(cntrs)
 
-        used_cpn = cpn.copy()
-        used_cpn["used_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        used[cid] = used_cpn
-        save_used(used)
-
-        del coupons[cid]
-        save_coupons(coupons)
-
-        await msg.answer(
-            f"✅ Купон успешно активирован!\n\n"
-            f"👤 Получатель: {cpn['recipient']}\n"
-            f"🆔 ID: {cpn['coupon_id']}\n"
-            f"📅 Действует до: {cpn['expiry_date']}\n"
-            f"⏰ Использован: {used_cpn['used_at']}\n"
-            f"📊 Всего использовано купонов: {cntrs[rcpt]}\n\n"
-            "✅ Купон помечен как использованный и удален из базы.",
-            reply_markup=get_admin_kb()
-        )
-
-        logging.info(f"Coupon {cid} used by {rcpt} at {used_cpn['used_at']}")
+        await msg.answer(batch_summary(scanned, results, unreadable), reply_markup=get_admin_kb())
+        logging.info(f"Batch scan: {sum(1 for r in results.values() if r.status == REDEEMED)} of {len(scanned)} redeemed")
 
     except Exception as e:
+        metrics.failed("process_qr", e)
         logging.error(f"Error processing QR code: {str(e)}")
         await msg.answer(
             "❌ Произошла ошибка при обработке QR-кода.\n"
@@ -515,29 +651,64 @@ async def process_qr(msg: Message):
 
 @dp.message(lambda msg: msg.text == "🎫 Мои купоны")
 async def my_coupons_btn(msg: Message):
-    usr_cpns = [c for c in coupons.values() if c.get("user_id") == msg.from_user.id]
+    uid = msg.from_user.id
+    usr_cpns = store.by_user(uid) + store.expired_by_user(uid) + store.used_by_user(uid)
     if not usr_cpns:
         await msg.answer("📭 У вас пока нет купонов.")
         return
 
+    now = time.time()
     resp = "🎫 Ваши купоны:\n\n"
     for cpn in usr_cpns:
-        status = "✅ Активен" if not cpn["used"] else "❌ Использован"
-        if datetime.strptime(cpn["expiry_date"], "%d.%m.%Y") < datetime.now():
+        if cpn.redeemed is not None:
+            status = "❌ Использован"
+        elif cpn.is_expired(now):
             status = "⏰ Истек"
+        else:
+            status = "✅ Активен"
         resp += (
-            f"🆔 {cpn['coupon_id']}\n"
-            f"📅 Действует до: {cpn['expiry_date']}\n"
+            f"🆔 {cpn.coupon_id}\n"
+            f"📅 Действует до: {cpn.expiry_date}\n"
             f"📊 Статус: {status}\n\n"
         )
-    await msg.answer(resp)
+    kb = None
+    if any(cpn.redeemed is None and not cpn.is_expired(now) for cpn in usr_cpns):
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📄 Прислать PDF снова", callback_data="pdf:my")]
+        ])
+    await msg.answer(resp, reply_markup=kb)
+
+@dp.callback_query(lambda cb: cb.data and cb.data.startswith("pdf:"))
+async def resend_pdf_btn(cb: types.CallbackQuery):
+    """Send the PDFs of the holder's or, for the admin, a recipient's active coupons again"""
+    if cb.data == "pdf:my":
+        cpns = store.by_user(cb.from_user.id)
+    elif cb.from_user.id != ADMIN_ID:
+        await cb.answer("⛔️ У вас нет доступа к этой функции.", show_alert=True)
+        return
+    else:
+        rcpt = listings.get(cb.data.split(":", 2)[2])
+        if rcpt is None:
+            await cb.answer("⌛ Список устарел, запросите его снова.", show_alert=True)
+            return
+        cpns = store.active_by_recipient(rcpt)
+
+    now = time.time()
+    cpns = [cpn for cpn in cpns if not cpn.is_expired(now)]
+    if not cpns:
+        await cb.answer("📭 Активных купонов нет.", show_alert=True)
+        return
+
+    await cb.answer("📄 Готовлю PDF...")
+    async for fname, pdf in render.cache.files(cpns):
+        await cb.message.answer_document(types.BufferedInputFile(pdf, filename=fname))
 
 @dp.message(lambda msg: msg.text == "🗑 Удалить купон")
 async def delete_coupon_btn(msg: Message, state: FSMContext):
     if msg.from_user.id != ADMIN_ID:
         await msg.answer("⛔️ У вас нет доступа к этой функции.")
         return
-    if not coupons:
+    if not store.has_active():
         await msg.answer("📭 Список купонов пуст.")
         return
 
@@ -548,7 +719,7 @@ async def delete_coupon_btn(msg: Message, state: FSMContext):
 async def process_delete_coupons(msg: Message, state: FSMContext):
     """Process coupon deletion by username and count"""
     rcpt = msg.text
-    usr_cpns = [c for c in coupons.values() if c["recipient"] == rcpt]
+    usr_cpns = store.active_by_recipient(rcpt)
 
     if not usr_cpns:
         await msg.answer(f"📭 Купоны для пользователя {rcpt} не найдены.")
@@ -570,7 +741,7 @@ async def process_delete_count(msg: Message, state: FSMContext):
         cnt = int(msg.text)
         data = await state.get_data()
         rcpt = data["delete_recipient"]
-        usr_cpns = [c for c in coupons.values() if c["recipient"] == rcpt]
+        usr_cpns = store.active_by_recipient(rcpt)
 
         if cnt < 1:
             await msg.answer("❌ Количество должно быть больше 0. Попробуйте снова:")
@@ -580,13 +751,11 @@ async def process_delete_count(msg: Message, state: FSMContext):
             await msg.answer(f"❌ У пользователя {rcpt} только {len(usr_cpns)} купонов. Попробуйте снова:")
             return
 
-        del_cnt = 0
-        for cpn in usr_cpns[:cnt]:
-            cid = cpn["coupon_id"]
-            del coupons[cid]
-            del_cnt += 1
-
-        save_coupons(coupons)
+        cids = [cpn.coupon_id for cpn in usr_cpns[:cnt]]
+        with metrics.phase("store_commit"):
+            store.delete(cids)
+        render.cache.evict(cids)
+        del_cnt = len(cids)
 
         await msg.answer(
             f"✅ Успешно удалено {del_cnt} купонов у пользователя {rcpt}!\n"
@@ -598,12 +767,54 @@ async def process_delete_count(msg: Message, state: FSMContext):
     except ValueError:
         await msg.answer("❌ Пожалуйста, введите число:")
 
+async def warm_up():
+    """Load the store and the imaging / PDF libraries in the background"""
+    phases = []
+    for name, load in (("store", store.load), ("render", render.warm_up), ("decode", decode.warm_up)):
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(load)
+        except Exception as e:
+            logging.error(f"Warm-up of {name} failed: {str(e)}")
+            continue
+        phases.append(f"{name} {time.perf_counter() - started:.2f}s")
+    logging.info(f"Warm-up done: {', '.join(phases)}")
+
+@dp.startup()
+async def on_startup():
+    """Report startup phases and kick off the optional warm-up"""
+    logging.info(
+        f"Startup: imports {IMPORT_TIME:.2f}s, "
+        f"receiving updates after {time.perf_counter() - STARTED:.2f}s, "
+        f"store {'loaded' if store.loaded else 'deferred'}"
+    )
+    if WARM_UP:
+        task = asyncio.create_task(warm_up())
+        background.add(task)
+        task.add_done_callback(background.discard)
+    sweeper.start()
+    await metrics.start_server()
+    await pos.start_server(store, on_redeemed=render.cache.evict)
+
+@dp.shutdown()
+async def on_shutdown():
+    await sweeper.stop()
+    await pos.stop_server()
+    await metrics.stop_server()
+
 async def main():
-    """Start the bot"""
-    await dp.start_polling(bot)
+    """Start the bot in polling or webhook mode"""
+    try:
+        if UPDATE_MODE == "webhook":
+            import webhook
+            await webhook.serve(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        render.shutdown()
+        store.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
 
 
@@ -0,0 +1,202 @@
+"""Bulk import and export of coupons without the bot.
+
+    python cli.py import campaign.csv --expiry 31.12.2026 --pdf-dir pdf/
+    python cli.py export used --format csv -o used.csv
+    python cli.py export active --format jsonl > active.jsonl
+
+``import`` reads a CSV with a header row and the columns ``recipient``,
+``count`` and optionally ``expiry`` (ДД.ММ.ГГГГ, falling back to
+``--expiry``) and ``user_id``, the Telegram id of the user holding the
+row's coupons. Only coupons with a holder show up under "My coupons" and
+reach that user in broadcasts and expiry notices. The file is checked completely first, then streamed into
+the store in batches of about ``--batch`` coupons, each committed with one
+journal record or transaction. With ``--pdf-dir`` every row's coupons are
+also rendered to PDFs there, which takes far longer than the import itself.
+
+``export`` streams active, used or expired coupons as CSV or JSON lines in
+the JSON schema of the store, one record at a time.
+
+The JSON store has a single writer, so ``import`` refuses to run while
+the bot holds it; ``export`` only reads its files and works either way.
+With ``STORE_BACKEND=sqlite`` both can run next to the bot.
+"""
+import os
+import re
+import csv
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+
+# Before the imports that read their settings from the environment
+load_dotenv()
+
+import codes
+import render
+from records import DATE_FMT, Coupon, parse_date
+from store import open_store
+
+COLUMNS = ("coupon_id", "recipient", "user_id", "expiry_date", "created_at", "used_at")
+
+def read_rows(path: str, default_expiry: Optional[str]) -> Iterator[Tuple[int, str, int, int, Optional[int]]]:
+    """Yield (line, recipient, count, expiry, user_id) for each CSV row, raising SystemExit on a bad one"""
+    now = time.time()
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or not {"recipient", "count"} <= set(reader.fieldnames):
+            raise SystemExit(f"{path}: the header needs the columns recipient and count")
+        for row in reader:
+            line = reader.line_num
+            rcpt = (row.get("recipient") or "").strip()
+            if not rcpt:
+                raise SystemExit(f"{path}:{line}: empty recipient")
+            try:
+                cnt = int(row["count"])
+            except (TypeError, ValueError):
+                raise SystemExit(f"{path}:{line}: count {row['count']!r} is not a number")
+            if cnt < 1:
+                raise SystemExit(f"{path}:{line}: count must be at least 1")
+            text = (row.get("expiry") or "").strip() or default_expiry
+            if not text:
+                raise SystemExit(f"{path}:{line}: no expiry and no --expiry given")
+            try:
+                expiry = parse_date(text)
+            except ValueError:
+                raise SystemExit(f"{path}:{line}: expiry {text!r} is not in the {DATE_FMT} format")
+            if expiry < now:
+                raise SystemExit(f"{path}:{line}: expiry {text} is in the past")
+            if not codes.signable(expiry):
+                raise SystemExit(f"{path}:{line}: expiry {text} is after {codes.LAST_EXPIRY.strftime(DATE_FMT)}")
+            uid = (row.get("user_id") or "").strip() or None
+            if uid is not None:
+                try:
+                    uid = int(uid)
+                except ValueError:
+                    raise SystemExit(f"{path}:{line}: user_id {uid!r} is not a number")
+            yield line, rcpt, cnt, expiry, uid
+
+def batches(rows: Iterator[tuple], size: int) -> Iterator[list]:
+    """Group rows into batches of about ``size`` coupons; a larger row is a batch of its own"""
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append(row)
+        total += row[2]
+        if total >= size:
+            yield batch
+            batch = []
+            total = 0
+    if batch:
+        yield batch
+
+def safe_name(name: str) -> str:
+    return re.sub(r"[^\w.@-]+", "_", name)
+
+async def render_row(line: int, cpns: list, pdf_dir: str, slots: asyncio.Semaphore) -> int:
+    """Render one row's coupons into ``pdf_dir``, returning the number of files"""
+    files = 0
+    try:
+        async for fname, pdf in render.render_chunks(cpns):
+            path = os.path.join(pdf_dir, f"{line}-{safe_name(fname)}")
+            with open(path, 'wb') as f:
+                f.write(pdf)
+            files += 1
+    finally:
+        slots.release()
+    return files
+
+async def import_csv(args):
+    # Check the whole file before anything is written
+    rows = sum(1 for _ in read_rows(args.csv, args.expiry))
+    if args.pdf_dir:
+        os.makedirs(args.pdf_dir, exist_ok=True)
+
+    try:
+        store = open_store()
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    started = time.perf_counter()
+    created = 0
+    renders = []
+    slots = asyncio.Semaphore(render.RENDER_WORKERS)
+    try:
+        for batch in batches(read_rows(args.csv, args.expiry), args.batch):
+            total = sum(row[2] for row in batch)
+            serial = store.reserve_serials(total)
+            now = int(time.time())
+            per_row = []
+            cpns = []
+            for line, rcpt, cnt, expiry, uid in batch:
+                part = [Coupon(codes.mint(serial + i, expiry), rcpt, expiry, now, user_id=uid) for i in range(cnt)]
+                serial += cnt
+                per_row.append((line, part))
+                cpns.extend(part)
+            store.add(cpns)
+            created += total
+            logging.info(f"Imported {created} coupons")
+
+            if args.pdf_dir:
+                for line, part in per_row:
+                    # Bounds the rows whose coupons are held for rendering
+                    await slots.acquire()
+                    renders.append(asyncio.create_task(render_row(line, part, args.pdf_dir, slots)))
+        imported = time.perf_counter() - started
+        files = sum(await asyncio.gather(*renders))
+    finally:
+        store.close()
+        render.shutdown()
+
+    print(f"Created {created} coupons for {rows} rows in {imported:.1f}s ({created / max(imported, 1e-9):.0f}/s)")
+    if args.pdf_dir:
+        print(f"Wrote {files} PDF files to {args.pdf_dir} in {time.perf_counter() - started:.1f}s")
+
+def export(args):
+    store = open_store(read_only=True)
+    try:
+        source = {"active": store.iter_active, "used": store.iter_used, "expired": store.iter_expired}[args.what]
+        out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            count = 0
+            if args.format == "csv":
+                writer = csv.DictWriter(out, COLUMNS, extrasaction='ignore')
+                writer.writeheader()
+                for cpn in source():
+                    writer.writerow(cpn.to_dict())
+                    count += 1
+            else:
+                for cpn in source():
+                    out.write(json.dumps(cpn.to_dict(), ensure_ascii=False) + "\n")
+                    count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        store.close()
+    logging.info(f"Exported {count} {args.what} coupons")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    imp = commands.add_parser("import", help="create coupons from a CSV of recipients and counts")
+    imp.add_argument("csv")
+    imp.add_argument("--expiry", default=None, help=f"expiry of rows without one, {DATE_FMT.replace('%', '%%')}")
+    imp.add_argument("--batch", type=int, default=10000, help="coupons committed together")
+    imp.add_argument("--pdf-dir", default=None, help="render every row's coupons to PDFs here")
+
+    exp = commands.add_parser("export", help="stream coupons out as CSV or JSON lines")
+    exp.add_argument("what", choices=("active", "used", "expired"))
+    exp.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    exp.add_argument("-o", "--output", default=None, help="file to write, standard output by default")
+
+    args = parser.parse_args()
+    if args.command == "import":
+        asyncio.run(import_csv(args))
+    else:
+        export(args)
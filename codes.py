@@ -0,0 +1,95 @@
+import os
+import hmac
+import base64
+import hashlib
+import logging
+import struct
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple
+
+from records import EXPIRED, INVALID, RedeemResult
+
+PREFIX = "PROMO-"
+LEGACY_LEN = 6
+EPOCH = date(2024, 1, 1)
+MAC_LEN = 4
+
+# serial (4 bytes) | expiry day since EPOCH, 0 = none (2 bytes) | truncated HMAC
+_PAYLOAD = struct.Struct(">IH")
+CODE_LEN = len(base64.b32encode(b"\0" * (_PAYLOAD.size + MAC_LEN)))
+# Last expiry day the payload can carry
+LAST_EXPIRY = EPOCH + timedelta(days=0xFFFF)
+
+@lru_cache(maxsize=None)
+def _secret() -> bytes:
+    """Signing key, resolved on first use so the bot has configured logging by then"""
+    secret = os.getenv("COUPON_SECRET")
+    if secret:
+        return secret.encode()
+    logging.warning("COUPON_SECRET is not set, deriving the coupon signing key from BOT_TOKEN")
+    return hashlib.sha256(b"coupon-code:" + os.getenv("BOT_TOKEN", "").encode()).digest()
+
+def _mac(payload: bytes) -> bytes:
+    return hmac.new(_secret(), payload, hashlib.sha256).digest()[:MAC_LEN]
+
+def _day(ts: int) -> int:
+    return (datetime.fromtimestamp(ts).date() - EPOCH).days
+
+def _day_start(day: int) -> float:
+    return datetime.combine(EPOCH + timedelta(days=day), datetime.min.time()).timestamp()
+
+def signable(expiry: int) -> bool:
+    """Whether a code can carry this expiry, i.e. it lies after EPOCH and up to LAST_EXPIRY"""
+    return 0 < _day(expiry) <= 0xFFFF
+
+def mint(serial: int, expiry: Optional[int] = None) -> str:
+    """Build a signed coupon code for a store-allocated serial"""
+    if expiry is not None and not signable(expiry):
+        raise ValueError(f"Expiry must fall after {EPOCH} and no later than {LAST_EXPIRY}")
+    payload = _PAYLOAD.pack(serial, 0 if expiry is None else _day(expiry))
+    return PREFIX + base64.b32encode(payload + _mac(payload)).decode()
+
+def prevalidate(code: str, now: float) -> Optional[str]:
+    """Check a scanned code without touching the store.
+
+    Returns INVALID for forged, mistyped or unknown-format codes, EXPIRED
+    when the signed expiry has passed, and None when the code has to be
+    looked up in the store (including legacy unsigned codes).
+    """
+    if not code.startswith(PREFIX):
+        return INVALID
+    body = code[len(PREFIX):]
+    if len(body) == LEGACY_LEN:
+        return None
+    if len(body) != CODE_LEN:
+        return INVALID
+
+    try:
+        raw = base64.b32decode(body)
+    except ValueError:
+        return INVALID
+    payload, mac = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    if not hmac.compare_digest(mac, _mac(payload)):
+        return INVALID
+
+    _, day = _PAYLOAD.unpack(payload)
+    if day and _day_start(day) < now:
+        return EXPIRED
+    return None
+
+def precheck(cids: list, now: float) -> Tuple[dict, list]:
+    """Split codes into the verdicts known without the store and the codes to look up.
+
+    Returns a dict of code -> RedeemResult for forged, malformed and expired
+    codes, and the remaining codes in their original order.
+    """
+    results = {}
+    lookup = []
+    for cid in cids:
+        verdict = prevalidate(cid, now)
+        if verdict is None:
+            lookup.append(cid)
+        else:
+            results[cid] = RedeemResult(verdict)
+    return results, lookup
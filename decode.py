@@ -0,0 +1,151 @@
+import io
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterator, List, Optional
+
+import metrics
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "4"))
+DECODE_CACHE = int(os.getenv("DECODE_CACHE", "1024"))
+DECODE_CACHE_TTL = float(os.getenv("DECODE_CACHE_TTL", "3600"))
+FAST_SIDE = 800
+UPSCALE_BELOW = 1000
+
+# zbar and OpenCV both release the GIL, so threads decode in parallel.
+# Both are imported on first use to keep them off the startup path.
+_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="qr-decode")
+
+def _scale(img: "np.ndarray", factor: float) -> "np.ndarray":
+    import cv2
+    interp = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+    return cv2.resize(img, None, fx=factor, fy=factor, interpolation=interp)
+
+def _attempts(gray: "np.ndarray") -> Iterator["np.ndarray"]:
+    """Yield progressively more expensive variants of a grayscale photo"""
+    import cv2
+    longest = max(gray.shape[:2])
+    if longest > FAST_SIDE:
+        yield _scale(gray, FAST_SIDE / longest)
+    yield gray
+    yield cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    yield cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+    if longest < UPSCALE_BELOW:
+        yield _scale(gray, 2)
+
+def decode_image(data: bytes) -> Optional[List[str]]:
+    """Decode every QR code in an encoded image.
+
+    Every pass runs and their codes are merged in the order found: in a
+    photo of several coupons, some codes may only decode at full resolution
+    or after thresholding. Returns None if the bytes are not a readable
+    image and an empty list if no QR code was found in any pass.
+    """
+    import cv2
+    import numpy as np
+    from pyzbar.pyzbar import ZBarSymbol, decode
+
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+
+    codes = {}
+    for img in _attempts(gray):
+        for d in decode(img, symbols=[ZBarSymbol.QRCODE]):
+            codes[d.data.decode()] = None
+    return list(codes)
+
+def warm_up():
+    """Import OpenCV and zbar ahead of the first scan"""
+    import cv2
+    from pyzbar import pyzbar
+
+async def download_photo(bot, file_id: str) -> bytes:
+    """Download a Telegram file into memory"""
+    file = await bot.get_file(file_id)
+    buf = io.BytesIO()
+    await bot.download_file(file.file_path, buf)
+    return buf.getvalue()
+
+class DecodeCache:
+    """LRU of decode results by Telegram ``file_unique_id``, each kept for ``ttl`` seconds.
+
+    A re-sent or forwarded photo has the same unique id, so its codes are
+    returned without downloading and decoding it again. A photo that is
+    still being decoded is not decoded twice: the second request waits for
+    the first one's result.
+    """
+
+    def __init__(self, size: int = DECODE_CACHE, ttl: float = DECODE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # Failed downloads are retried next time
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, key: str, load: Callable[[], Awaitable]):
+        """Return the cached result of ``key``, calling ``load`` on a miss"""
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(load())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # A cancelled caller must not cancel the decode others wait for
+        return await asyncio.shield(task)
+
+cache = DecodeCache()
+metrics.register(metrics.Gauge("decode_cache_hits_total", "Photos answered from the decode cache",
+                               lambda: cache.hits, "counter"))
+metrics.register(metrics.Gauge("decode_cache_misses_total", "Photos downloaded and decoded",
+                               lambda: cache.misses, "counter"))
+metrics.register(metrics.Gauge("decode_cache_entries", "Decode results in the cache", lambda: len(cache)))
+
+async def decode_photo(bot, file_id: str, unique_id: Optional[str] = None) -> Optional[List[str]]:
+    """Return the QR codes of a photo, from the cache when ``unique_id`` was seen recently"""
+    if unique_id is None or cache.size <= 0:
+        return await _decode_photo(bot, file_id)
+    return await cache.fetch(unique_id, lambda: _decode_photo(bot, file_id))
+
+async def _decode_photo(bot, file_id: str) -> Optional[List[str]]:
+    """Download a photo and decode its QR codes in the worker pool"""
+    with metrics.phase("download"):
+        data = await download_photo(bot, file_id)
+    loop = asyncio.get_running_loop()
+    with metrics.phase("decode"):
+        return await loop.run_in_executor(_pool, decode_image, data)
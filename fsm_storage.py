@@ -0,0 +1,82 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from sqlite_store import BUSY_TIMEOUT
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+# Not the coupon database: every commit there makes SqliteStore reload its stats
+FSM_PATH = os.getenv("FSM_PATH", "fsm.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT
+);
+"""
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+class SqliteStorage(BaseStorage):
+    """FSM storage in a SQLite table, shared by every bot process using the same file.
+
+    Dialog states survive restarts, and an update handled by another worker
+    process sees the state left by the previous one. Each call is a single
+    autocommitted statement.
+    """
+
+    def __init__(self, path: str = FSM_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def _row(self, key: StorageKey) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (_key(key),)).fetchone()
+
+    def _set(self, key: StorageKey, column: str, value: Optional[str]):
+        k = _key(key)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO fsm (key, {column}) VALUES (?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}",
+                (k, value)
+            )
+            # Finished dialogs leave nothing behind
+            self._conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data IS NULL", (k,))
+
+    async def set_state(self, key: StorageKey, state: Any = None) -> None:
+        self._set(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = self._row(key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._set(key, "data", json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = self._row(key)
+        return json.loads(row[1]) if row and row[1] else {}
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def open_storage() -> Optional[BaseStorage]:
+    """Create the FSM storage selected by the FSM_STORAGE env var, None for aiogram's in-memory one"""
+    if FSM_STORAGE == "memory":
+        return None
+    if FSM_STORAGE == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"Unknown FSM_STORAGE {FSM_STORAGE!r}, expected 'memory' or 'sqlite'")
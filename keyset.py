@@ -0,0 +1,50 @@
+import bisect
+from typing import Iterator, Optional, Tuple
+
+# Keyset pagination cursor: (timestamp, coupon_id) of the last row shown
+Cursor = Tuple[int, str]
+
+class SortedIndex:
+    """Sorted list of (timestamp, coupon_id) keys for keyset pagination.
+
+    Keys mostly arrive in timestamp order, so inserts are usually appends.
+    A page is a bisect plus a slice, whatever the size of the index.
+    """
+
+    __slots__ = ("keys",)
+
+    def __init__(self, keys: Optional[list] = None):
+        self.keys = [] if keys is None else keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __iter__(self) -> Iterator[Cursor]:
+        return iter(self.keys)
+
+    def add(self, key: Cursor):
+        if not self.keys or self.keys[-1] < key:
+            self.keys.append(key)
+        else:
+            bisect.insort(self.keys, key)
+
+    def discard(self, key: Cursor):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def page(self, limit: int, cursor: Optional[Cursor] = None, back: bool = False,
+             desc: bool = False) -> list:
+        """Return up to ``limit`` keys following ``cursor`` in display order.
+
+        ``desc`` shows newest first; ``back`` returns the keys preceding the
+        cursor instead, still in display order.
+        """
+        keys = self.keys
+        if back == desc:
+            i = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            part = keys[i:i + limit]
+        else:
+            j = len(keys) if cursor is None else bisect.bisect_left(keys, cursor)
+            part = keys[max(0, j - limit):j]
+        return part[::-1] if desc else part
@@ -0,0 +1,302 @@
+"""Load test for the update path: a fake Telegram Bot API plus an update generator.
+
+Start the bot against the fake API, in either mode (add SEND_RATE=0
+CHAT_RATE=0 to take the outbound rate limits out of the measurement):
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 UPDATE_MODE=webhook python bot.py
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+
+then drive it with the matching mode (for polling, start loadgen.py first:
+it serves the API the bot connects to, and waits for the first getUpdates):
+
+    python loadgen.py --mode webhook --updates 5000 --chats 200
+    python loadgen.py --mode polling --updates 5000 --chats 200
+
+Every generated update is a /start from one of ``--chats`` users, which
+the bot answers with one message. Latency is measured from handing the
+update over (webhook POST or getUpdates queue) to the bot's sendMessage
+reaching the fake API; replies of a chat are matched to its updates in order.
+
+``--flood`` makes the fake API answer like Telegram when its flood limits
+are exceeded (429 with retry_after). ``--notify N`` additionally has the
+admin (``--admin``, the bot's ADMIN_ID) broadcast a notification to N users
+while the /start traffic runs, and reports how long delivery took:
+
+    python loadgen.py --mode polling --flood --notify 600 --updates 300 --rate 20
+"""
+import time
+import asyncio
+import argparse
+import itertools
+import json
+from collections import defaultdict, deque
+
+from aiohttp import ClientConnectionError, ClientSession, web
+
+from sender import CHAT_BURST, CHAT_RATE, SEND_RATE, TokenBucket
+from webhook import percentile
+
+# First user id of the notified users
+NOTIFY_BASE = 100000
+
+class FakeTelegram:
+    """Just enough of the Bot API for the bot to poll and reply"""
+
+    def __init__(self, flood: bool = False, admin: int = 0, notify: int = 0):
+        self.flood = flood
+        self.admin = admin
+        self.notify = range(NOTIFY_BASE, NOTIFY_BASE + notify)
+        self.notified = 0
+        self.notify_started = None
+        self.notify_done = None
+        self.admin_replied = asyncio.Event()
+        self.flood_waits = 0
+        self.bucket = TokenBucket(SEND_RATE, SEND_RATE)
+        self.chat_buckets = defaultdict(lambda: TokenBucket(CHAT_RATE, CHAT_BURST))
+        self.pending = deque()
+        self.arrived = asyncio.Event()
+        self.polling = asyncio.Event()
+        self.sent_at = defaultdict(deque)
+        self.latencies = []
+        self.replies = 0
+        self.first_sent = None
+        self.last_reply = None
+        self.done = asyncio.Event()
+        self.expected = 0
+        self._message_ids = itertools.count(1)
+
+    def track(self, chat_id: int):
+        now = time.perf_counter()
+        if self.first_sent is None:
+            self.first_sent = now
+        self.sent_at[chat_id].append(now)
+
+    def enqueue(self, update: dict):
+        self.track(update["message"]["chat"]["id"])
+        self.pending.append(update)
+        self.arrived.set()
+
+    def _message(self, chat_id: int, text: str = "") -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text
+        }
+
+    async def _get_updates(self, params: dict) -> list:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        while self.pending and self.pending[0]["update_id"] < offset:
+            self.pending.popleft()
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                return []
+        return list(itertools.islice(self.pending, int(params.get("limit") or 100)))
+
+    def _flooded(self, chat_id: int) -> float:
+        """Seconds to wait if this message exceeds the flood limits, else 0"""
+        now = time.monotonic()
+        chat = self.chat_buckets[chat_id]
+        wait = max(self.bucket.delay(now), chat.delay(now))
+        if wait > 0:
+            self.flood_waits += 1
+            return wait
+        self.bucket.take()
+        chat.take()
+        return 0
+
+    def _reply(self, chat_id: int):
+        now = time.perf_counter()
+        if chat_id in self.notify:
+            self.notified += 1
+            if self.notified == len(self.notify):
+                self.notify_done = now
+                self._check_done()
+            return
+        if chat_id == self.admin:
+            self.admin_replied.set()
+            return
+        sent = self.sent_at.get(chat_id)
+        if sent:
+            self.latencies.append(now - sent.popleft())
+        self.replies += 1
+        self.last_reply = now
+        self._check_done()
+
+    def _check_done(self):
+        if self.replies >= self.expected and self.notified >= len(self.notify):
+            self.done.set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load", "username": "load_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            wait = self._flooded(chat_id) if self.flood else 0
+            if wait:
+                retry_after = max(1, round(wait))
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after}
+                }, status=429)
+            if method == "sendMessage":
+                self._reply(chat_id)
+            result = self._message(chat_id, params.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def report(self, rejected: int) -> dict:
+        lat = sorted(self.latencies)
+        elapsed = (self.last_reply or time.perf_counter()) - (self.first_sent or time.perf_counter())
+        out = {}
+        if self.notify:
+            took = (self.notify_done or time.perf_counter()) - (self.notify_started or time.perf_counter())
+            out = {"notified": self.notified, "notify_seconds": round(took, 3)}
+        if self.flood:
+            out["flood_waits"] = self.flood_waits
+        return {
+            **out,
+            "replies": self.replies,
+            "rejected": rejected,
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(self.replies / elapsed, 1) if elapsed > 0 else 0.0,
+            "p50_ms": round(percentile(lat, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(lat, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(lat, 0.99) * 1000, 2)
+        }
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    msg = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+        "text": text
+    }
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": msg}
+
+async def paced(count: int, rate: float):
+    """Yield update numbers, at most ``rate`` per second when rate > 0"""
+    started = time.perf_counter()
+    for i in range(count):
+        if rate > 0:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield i
+
+def admin_updates(args) -> list:
+    """The admin's broadcast dialog for ``--notify``"""
+    targets = ",".join(str(NOTIFY_BASE + i) for i in range(args.notify))
+    texts = ["📣 Рассылка", targets, "⏰ Ваши купоны скоро истекают"]
+    return [make_update(args.updates + 1 + i, args.admin, text) for i, text in enumerate(texts)]
+
+async def admin_dialog(fake: FakeTelegram, args, send):
+    """Walk the admin through the broadcast dialog, waiting for each answer"""
+    for update in admin_updates(args):
+        fake.admin_replied.clear()
+        # The last step starts the broadcast
+        fake.notify_started = time.perf_counter()
+        await send(update)
+        await asyncio.wait_for(fake.admin_replied.wait(), args.timeout)
+
+async def drive_webhook(fake: FakeTelegram, args) -> int:
+    """POST updates to the bot's webhook; refused ones are retried like Telegram does.
+
+    A webhook that is not listening yet, or restarting, counts as refused.
+    """
+    rejected = 0
+    sem = asyncio.Semaphore(args.concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+
+    async with ClientSession() as http:
+        async def post(update: dict):
+            nonlocal rejected
+            async with sem:
+                if update["message"]["chat"]["id"] != args.admin:
+                    fake.track(update["message"]["chat"]["id"])
+                while True:
+                    try:
+                        async with http.post(args.webhook, data=json.dumps(update), headers={
+                            "Content-Type": "application/json", **headers
+                        }) as resp:
+                            if resp.status == 200:
+                                return
+                    except ClientConnectionError:
+                        pass
+                    rejected += 1
+                    await asyncio.sleep(0.05)
+
+        tasks = []
+        if args.notify:
+            await admin_dialog(fake, args, post)
+        async for i in paced(args.updates, args.rate):
+            tasks.append(asyncio.create_task(post(make_update(i + 1, 1000 + i % args.chats, args.text))))
+        await asyncio.gather(*tasks)
+    return rejected
+
+async def drive_polling(fake: FakeTelegram, args) -> int:
+    """Queue updates for getUpdates once the bot has started polling"""
+    await fake.polling.wait()
+    if args.notify:
+        async def send(update: dict):
+            fake.pending.append(update)
+            fake.arrived.set()
+        await admin_dialog(fake, args, send)
+    async for i in paced(args.updates, args.rate):
+        fake.enqueue(make_update(i + 1, 1000 + i % args.chats, args.text))
+    return 0
+
+async def main(args):
+    fake = FakeTelegram(args.flood, args.admin, args.notify)
+    fake.expected = args.updates
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake Bot API on http://{args.host}:{args.port}, sending {args.updates} updates ({args.mode})")
+
+    try:
+        drive = drive_webhook if args.mode == "webhook" else drive_polling
+        rejected = await drive(fake, args)
+        try:
+            await asyncio.wait_for(fake.done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out with {fake.replies} of {args.updates} replies")
+        print(json.dumps({"mode": args.mode, **fake.report(rejected)}, indent=2))
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel webhook requests")
+    parser.add_argument("--text", default="/start")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--flood", action="store_true", help="enforce Telegram's flood limits")
+    parser.add_argument("--notify", type=int, default=0, help="users the admin broadcasts to")
+    parser.add_argument("--admin", type=int, default=1, help="the bot's ADMIN_ID")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,242 @@
+import os
+import glob
+import time
+import random
+import logging
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SLOW_UPDATE = float(os.getenv("SLOW_UPDATE_MS", "1000")) / 1000
+PROFILE = os.getenv("PROFILE", "0") == "1"
+PROFILE_SAMPLE = float(os.getenv("PROFILE_SAMPLE", "0.1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+# Upper bounds in seconds, from a store lookup up to a large PDF batch
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = "coupon_bot_"
+
+# Phase name -> seconds spent in it by the update being handled
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("timings", default=None)
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Monotonic count per label values"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, count in items:
+            yield f"{self.name}{_labels(self.labels, values)} {count}"
+
+class Gauge:
+    """Value read from ``fn`` at scrape time"""
+
+    def __init__(self, name: str, doc: str, fn: Callable[[], float], kind: str = "gauge"):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {self.fn()}"
+
+class Histogram:
+    """Distribution of durations in seconds per label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = PREFIX + name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket and +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *values):
+        with self._lock:
+            series = self._values.get(values)
+            if series is None:
+                series = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted((values, (list(counts), total)) for values, (counts, total) in self._values.items())
+        names = self.labels + ("le",)
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {cumulative}"
+
+HANDLER_SECONDS = Histogram("handler_seconds", "Time spent in a handler", ("handler",))
+HANDLER_ERRORS = Counter("handler_errors_total", "Handler failures by exception type", ("handler", "error"))
+QUEUE_WAIT = Histogram("queue_wait_seconds", "Time a webhook update waited in its queue")
+PHASE_SECONDS = Histogram("phase_seconds", "Time spent in a phase of a handler", ("phase",))
+SLOW_UPDATES = Counter("slow_updates_total", "Updates handled slower than SLOW_UPDATE_MS", ("handler",))
+
+_registry = [HANDLER_SECONDS, HANDLER_ERRORS, QUEUE_WAIT, PHASE_SECONDS, SLOW_UPDATES]
+
+def register(metric):
+    """Add a metric to the ones served on the endpoint"""
+    _registry.append(metric)
+    return metric
+
+def exposition() -> str:
+    """Render every metric in the Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+def record(name: str, seconds: float):
+    """Count ``seconds`` towards a phase, and towards the update being handled"""
+    PHASE_SECONDS.observe(seconds, name)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+@contextmanager
+def phase(name: str):
+    """Time the block as a phase, e.g. ``with metrics.phase("decode"):``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+def failed(handler: str, e: BaseException):
+    """Count an error a handler caught and answered itself"""
+    HANDLER_ERRORS.inc(handler, type(e).__name__)
+
+class MetricsMiddleware:
+    """Dispatcher middleware timing every handler and its phases.
+
+    Register it as an inner middleware of the message and callback query
+    observers, so the matched handler is known. Updates slower than ``slow``
+    are logged with the time spent in each phase. With ``profile`` a
+    ``sample`` share of the updates runs under cProfile, and the profile of
+    a slow one is written to ``profile_dir``. cProfile sees everything the
+    event loop runs meanwhile, so only one update is profiled at a time.
+    """
+
+    def __init__(self, slow: float = SLOW_UPDATE, profile: bool = PROFILE,
+                 sample: float = PROFILE_SAMPLE, profile_dir: str = PROFILE_DIR):
+        self.slow = slow
+        self.profile = profile
+        self.sample = sample
+        self.profile_dir = profile_dir
+        self._profiling = False
+
+    def _start_profile(self) -> Optional[cProfile.Profile]:
+        if not self.profile or self._profiling or random.random() >= self.sample:
+            return None
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiler is already attached to this thread
+            return None
+        self._profiling = True
+        return prof
+
+    def _dump(self, prof: cProfile.Profile, handler: str, elapsed: float) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.profile_dir, f"{stamp}-{handler}-{elapsed * 1000:.0f}ms.prof")
+        prof.dump_stats(path)
+        for old in sorted(glob.glob(os.path.join(self.profile_dir, "*.prof")), key=os.path.getmtime)[:-PROFILE_KEEP]:
+            os.remove(old)
+        return path
+
+    async def __call__(self, handler, event, data: dict):
+        obj = data.get("handler")
+        name = getattr(getattr(obj, "callback", None), "__name__", "unknown")
+        timings = {}
+        token = _timings.set(timings)
+        prof = self._start_profile()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            failed(name, e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if prof is not None:
+                prof.disable()
+                self._profiling = False
+            _timings.reset(token)
+            HANDLER_SECONDS.observe(elapsed, name)
+            if self.slow and elapsed >= self.slow:
+                SLOW_UPDATES.inc(name)
+                phases = ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in timings.items())
+                logging.warning(f"Slow update in {name}: {elapsed * 1000:.0f} ms ({phases or 'no phases'})")
+                if prof is not None:
+                    try:
+                        logging.warning(f"Profile written to {self._dump(prof, name, elapsed)}")
+                    except OSError as e:
+                        logging.error(f"Writing the profile failed: {str(e)}")
+
+_runner = None
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Serve ``GET /metrics`` in the Prometheus text format; port 0 disables it"""
+    global _runner
+    if not port or _runner is not None:
+        return
+    from aiohttp import web
+
+    async def scrape(request: web.Request) -> web.Response:
+        return web.Response(body=exposition().encode(), headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8"
+        })
+
+    app = web.Application()
+    app.router.add_get("/metrics", scrape)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,239 @@
+"""HTTP API for point-of-sale terminals that decode the QR codes themselves.
+
+    POS_PORT=8070 python bot.py             # next to the bot
+    STORE_BACKEND=sqlite python pos.py      # on its own
+
+    GET  /coupons/{code}              the coupon and its state
+    GET  /coupons/{code}/validate     whether redeeming it would succeed
+    POST /coupons/{code}/redeem       redeem it
+    POST /batch                       {"action": "lookup" | "validate" | "redeem", "codes": [...]}
+
+Codes go through the same checks as a scanned photo: the signature and
+signed expiry first, then the store. Every answer is 200 with a ``status``
+per code (valid, redeemed, already_used, expired, not_found or invalid).
+Redemptions arriving in the same turn of the event loop are committed
+together as one ``redeem_many`` call, so concurrent terminals share a
+journal write or SQLite transaction instead of taking one each. The store
+is called on the event loop, like from the bot's handlers.
+Run on its own, the API opens the store itself and requires the SQLite
+one, which it can share with the bot.
+"""
+import os
+import hmac
+import time
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import codes
+import metrics
+from records import ALREADY_USED, EXPIRED, NOT_FOUND, REDEEMED, Coupon, RedeemResult
+
+load_dotenv()
+
+POS_HOST = os.getenv("POS_HOST", "127.0.0.1")
+POS_PORT = int(os.getenv("POS_PORT", "0"))
+POS_TOKEN = os.getenv("POS_TOKEN")
+POS_MAX_BATCH = int(os.getenv("POS_MAX_BATCH", "1000"))
+
+# Port of ``python pos.py`` when POS_PORT is not set
+DEFAULT_PORT = 8070
+
+VALID = "valid"
+ACTIONS = ("lookup", "validate", "redeem")
+
+REQUEST_SECONDS = metrics.register(metrics.Histogram("pos_request_seconds", "POS API request latency", ("endpoint",)))
+RESULTS = metrics.register(metrics.Counter("pos_results_total", "POS API answers per action and status",
+                                           ("action", "status")))
+
+def state_of(cpn: Optional[Coupon], now: float) -> str:
+    """Status a redemption of this coupon would get right now"""
+    if cpn is None:
+        return NOT_FOUND
+    if cpn.redeemed is not None:
+        return ALREADY_USED
+    if cpn.is_expired(now):
+        return EXPIRED
+    return VALID
+
+def describe(cid: str, status: str, cpn: Optional[Coupon] = None, count: Optional[int] = None) -> dict:
+    out = {"code": cid, "status": status}
+    if cpn is not None:
+        out.update(recipient=cpn.recipient, expiry_date=cpn.expiry_date, used_at=cpn.used_at)
+    if count is not None:
+        out["redemptions"] = count
+    return out
+
+class RedeemBatcher:
+    """Group commit of concurrent redemptions.
+
+    Codes submitted before the flush task gets its turn on the event loop,
+    such as those of the requests read in one pass over the sockets, go
+    into one ``redeem_many`` call together, in arrival order. A code
+    submitted twice is redeemed once; the later submission gets
+    ALREADY_USED, exactly as with separate calls.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.commits = 0
+        self._pending = []
+        self._task = None
+
+    async def redeem(self, cids: list) -> list:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((cids, fut))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+        return await fut
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        cids = [cid for part, _ in batch for cid in part]
+        try:
+            results = self.store.redeem_many(cids, int(time.time()))
+        except Exception as e:
+            logging.error(f"Redeeming {len(cids)} codes failed: {str(e)}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.commits += 1
+        pos = 0
+        for part, fut in batch:
+            if not fut.done():
+                fut.set_result(results[pos:pos + len(part)])
+            pos += len(part)
+
+class PosApi:
+    """Lookup, validation and redemption of coupon codes against the store"""
+
+    def __init__(self, store, on_redeemed: Optional[Callable[[list], None]] = None):
+        self.store = store
+        self.on_redeemed = on_redeemed
+        self.batcher = RedeemBatcher(store)
+
+    def lookup(self, cids: list) -> list:
+        now = time.time()
+        out = []
+        for cid in cids:
+            cpn = self.store.find(cid)
+            out.append(describe(cid, state_of(cpn, now), cpn))
+        return out
+
+    def validate(self, cids: list) -> list:
+        now = time.time()
+        verdicts, lookup = codes.precheck(cids, now)
+        found = {cid: state_of(self.store.find(cid), now) for cid in lookup}
+        return [describe(cid, verdicts[cid].status if cid in verdicts else found[cid]) for cid in cids]
+
+    async def redeem(self, cids: list) -> list:
+        verdicts, lookup = codes.precheck(cids, time.time())
+        # One result per looked up code, so a repeated code keeps its own outcome
+        found = iter(await self.batcher.redeem(lookup) if lookup else ())
+        out = []
+        for cid in cids:
+            res: RedeemResult = verdicts.get(cid) or next(found)
+            out.append(describe(cid, res.status, res.coupon, res.count if res.status == REDEEMED else None))
+        if self.on_redeemed is not None:
+            self.on_redeemed([r["code"] for r in out if r["status"] == REDEEMED])
+        return out
+
+    async def run(self, action: str, cids: list) -> list:
+        if action == "redeem":
+            out = await self.redeem(cids)
+        else:
+            out = getattr(self, action)(cids)
+        for res in out:
+            RESULTS.inc(action, res["status"])
+        return out
+
+def create_app(api: PosApi, token: Optional[str] = POS_TOKEN, max_batch: int = POS_MAX_BATCH) -> web.Application:
+    """Build the aiohttp app of the POS API"""
+
+    @web.middleware
+    async def guard(request: web.Request, handler):
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, request.match_info.route.name or "unknown")
+
+    async def lookup(request: web.Request) -> web.Response:
+        return web.json_response((await api.run("lookup", [request.match_info["code"]]))[0])
+
+    async def validate(request: web.Request) -> web.Response:
+        return web.json_response((await api.run("validate", [request.match_info["code"]]))[0])
+
+    async def redeem(request: web.Request) -> web.Response:
+        return web.json_response((await api.run("redeem", [request.match_info["code"]]))[0])
+
+    async def batch(request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            action = body.get("action", "validate")
+            cids = body["codes"]
+        except (ValueError, AttributeError, KeyError):
+            return web.json_response({"error": "expected {\"action\": ..., \"codes\": [...]}"}, status=400)
+        if action not in ACTIONS or not isinstance(cids, list) or not all(isinstance(c, str) for c in cids):
+            return web.json_response({"error": f"action must be one of {', '.join(ACTIONS)}, codes a list of strings"},
+                                     status=400)
+        if len(cids) > max_batch:
+            return web.json_response({"error": f"at most {max_batch} codes per batch"}, status=413)
+        return web.json_response({"results": await api.run(action, cids)})
+
+    app = web.Application(middlewares=[guard])
+    app.router.add_get("/coupons/{code}", lookup, name="lookup")
+    app.router.add_get("/coupons/{code}/validate", validate, name="validate")
+    app.router.add_post("/coupons/{code}/redeem", redeem, name="redeem")
+    app.router.add_post("/batch", batch, name="batch")
+    return app
+
+_runner = None
+
+async def start_server(store, host: str = POS_HOST, port: int = POS_PORT,
+                       on_redeemed: Optional[Callable[[list], None]] = None):
+    """Serve the POS API next to the bot; port 0 disables it.
+
+    ``on_redeemed`` is called with the ids of the coupons each request redeemed.
+    """
+    global _runner
+    if not port or _runner is not None:
+        return
+    _runner = web.AppRunner(create_app(PosApi(store, on_redeemed)), access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logging.info(f"POS API on http://{host}:{port}")
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+async def main():
+    from store import STORE_BACKEND, open_store
+    if STORE_BACKEND != "sqlite":
+        raise SystemExit("The POS API shares coupons with the bot through SQLite, set STORE_BACKEND=sqlite")
+
+    store = open_store()
+    await metrics.start_server()
+    await start_server(store, port=POS_PORT or DEFAULT_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_server()
+        await metrics.stop_server()
+        store.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,129 @@
+"""Load test for the POS API of pos.py.
+
+Create coupons to test with in the store the API will use (with the JSON
+store, while neither the bot nor the API is running), then start the API
+and drive it:
+
+    STORE_BACKEND=sqlite python posload.py --seed 20000
+    STORE_BACKEND=sqlite python pos.py
+    python posload.py --action validate --requests 20000 --concurrency 64
+    python posload.py --action redeem --requests 20000 --concurrency 64
+    python posload.py --action redeem --batch 50 --requests 400
+
+``--seed`` writes the new codes to ``--codes``, which the runs read back.
+Redemptions walk through the codes in order, so each is redeemed once
+while there are enough of them; lookups and validations pick codes at
+random. ``--batch`` sends that many codes per ``POST /batch`` instead of
+one per request.
+"""
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import json
+from collections import Counter
+
+from aiohttp import ClientSession, TCPConnector
+
+from webhook import percentile
+
+def seed(count: int, path: str, days: int):
+    """Create ``count`` coupons in the configured store and write their codes to ``path``"""
+    import codes
+    from records import Coupon
+    from store import open_store
+
+    store = open_store()
+    try:
+        now = int(time.time())
+        expiry = now + days * 86400
+        start = store.reserve_serials(count)
+        cpns = [Coupon(codes.mint(start + i, expiry), "posload", expiry, now) for i in range(count)]
+        for i in range(0, count, 10000):
+            store.add(cpns[i:i + 10000])
+    finally:
+        store.close()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(c.coupon_id + "\n" for c in cpns)
+    print(f"Created {count} coupons, codes in {path}")
+
+async def drive(args, codes: list) -> dict:
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    ordered = itertools.cycle(codes)
+    numbers = iter(range(args.requests))
+    latencies = []
+    statuses = Counter()
+    errors = 0
+
+    def pick() -> list:
+        if args.action == "redeem":
+            return list(itertools.islice(ordered, args.batch))
+        return random.choices(codes, k=args.batch)
+
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency), headers=headers) as http:
+        async def request(cids: list) -> list:
+            if args.batch > 1:
+                async with http.post(f"{args.url}/batch", json={"action": args.action, "codes": cids}) as resp:
+                    resp.raise_for_status()
+                    return (await resp.json())["results"]
+            path = {"lookup": "", "validate": "/validate", "redeem": "/redeem"}[args.action]
+            method = http.post if args.action == "redeem" else http.get
+            async with method(f"{args.url}/coupons/{cids[0]}{path}") as resp:
+                resp.raise_for_status()
+                return [await resp.json()]
+
+        async def client():
+            nonlocal errors
+            for _ in numbers:
+                cids = pick()
+                started = time.perf_counter()
+                try:
+                    results = await request(cids)
+                except Exception:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                statuses.update(r["status"] for r in results)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    lat = sorted(latencies)
+    return {
+        "action": args.action,
+        "batch": args.batch,
+        "requests": len(lat),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(lat) / elapsed, 1),
+        "codes_per_sec": round(sum(statuses.values()) / elapsed, 1),
+        "p50_ms": round(percentile(lat, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(lat, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(lat, 0.99) * 1000, 2),
+        "statuses": dict(statuses)
+    }
+
+def main(args):
+    if args.seed:
+        seed(args.seed, args.codes, args.days)
+        return
+    with open(args.codes, 'r', encoding='utf-8') as f:
+        codes = [line.strip() for line in f if line.strip()]
+    if not codes:
+        raise SystemExit(f"No codes in {args.codes}, create some with --seed")
+    print(json.dumps(asyncio.run(drive(args, codes)), indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=0, help="create this many coupons and exit")
+    parser.add_argument("--days", type=int, default=30, help="validity of seeded coupons")
+    parser.add_argument("--codes", default="posload_codes.txt")
+    parser.add_argument("--action", choices=("lookup", "validate", "redeem"), default="validate")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=1, help="codes per request, over 1 uses POST /batch")
+    parser.add_argument("--url", default="http://127.0.0.1:8070")
+    parser.add_argument("--token", default=None, help="the API's POS_TOKEN")
+    main(parser.parse_args())
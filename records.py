@@ -0,0 +1,102 @@
+import sys
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+DATE_FMT = "%d.%m.%Y"
+STAMP_FMT = "%Y-%m-%d %H:%M:%S"
+
+def parse_date(s: str) -> int:
+    """Epoch of local midnight for a ДД.ММ.ГГГГ date"""
+    return int(datetime.strptime(s, DATE_FMT).timestamp())
+
+def parse_stamp(s: str) -> int:
+    """Epoch of a created_at / used_at stamp"""
+    return int(datetime.strptime(s, STAMP_FMT).timestamp())
+
+def fmt_date(ts: int) -> str:
+    return time.strftime(DATE_FMT, time.localtime(ts))
+
+def fmt_stamp(ts: int) -> str:
+    return time.strftime(STAMP_FMT, time.localtime(ts))
+
+class Coupon:
+    """Compact coupon record with timestamps pre-parsed to epoch seconds.
+
+    Records are treated as immutable: redeeming produces a new record, so a
+    coupon can be shared between indexes and snapshot copies safely. The
+    string fields of the JSON schema are exposed as properties for display
+    and are only produced at the storage boundary by ``to_dict``.
+    """
+
+    __slots__ = ("coupon_id", "recipient", "expiry", "created", "redeemed", "user_id")
+
+    def __init__(self, coupon_id: str, recipient: str, expiry: int, created: int,
+                 redeemed: Optional[int] = None, user_id: Optional[int] = None):
+        self.coupon_id = coupon_id
+        self.recipient = sys.intern(recipient)
+        self.expiry = expiry
+        self.created = created
+        self.redeemed = redeemed
+        self.user_id = user_id
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Coupon":
+        """Build a record from the JSON coupon schema"""
+        return cls(
+            d["coupon_id"],
+            d["recipient"],
+            parse_date(d["expiry_date"]),
+            parse_stamp(d["created_at"]),
+            parse_stamp(d["used_at"]) if d.get("used_at") else None,
+            d.get("user_id")
+        )
+
+    def to_dict(self) -> dict:
+        """Convert back to the JSON coupon schema"""
+        d = {
+            "coupon_id": self.coupon_id,
+            "recipient": self.recipient,
+            "expiry_date": self.expiry_date,
+            "created_at": self.created_at,
+            "used": False
+        }
+        if self.user_id is not None:
+            d["user_id"] = self.user_id
+        if self.redeemed is not None:
+            d["used_at"] = self.used_at
+        return d
+
+    def redeem(self, ts: int) -> "Coupon":
+        """Return the used copy of this coupon"""
+        return Coupon(self.coupon_id, self.recipient, self.expiry, self.created, ts, self.user_id)
+
+    def is_expired(self, now: float) -> bool:
+        return self.expiry < now
+
+    @property
+    def expiry_date(self) -> str:
+        return fmt_date(self.expiry)
+
+    @property
+    def created_at(self) -> str:
+        return fmt_stamp(self.created)
+
+    @property
+    def used_at(self) -> Optional[str]:
+        return None if self.redeemed is None else fmt_stamp(self.redeemed)
+
+    def __repr__(self) -> str:
+        return f"Coupon({self.coupon_id!r}, {self.recipient!r}, expiry={self.expiry}, redeemed={self.redeemed})"
+
+REDEEMED = "redeemed"
+NOT_FOUND = "not_found"
+EXPIRED = "expired"
+ALREADY_USED = "already_used"
+INVALID = "invalid"
+
+class RedeemResult(NamedTuple):
+    """Outcome of an atomic redeem attempt"""
+    status: str
+    coupon: Optional[Coupon] = None
+    count: int = 0
@@ -0,0 +1,297 @@
+import io
+import os
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, List, Optional, Tuple
+
+import metrics
+
+if TYPE_CHECKING:
+    from reportlab.pdfgen import canvas
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+PDF_CHUNK_PAGES = int(os.getenv("PDF_CHUNK_PAGES", "500"))
+PDF_CACHE_MB = float(os.getenv("PDF_CACHE_MB", "64"))
+
+PAGE_FORM = "coupon_page"
+# Size of a rendered page until the cache has measured some
+PAGE_BYTES = 2048
+
+# qrcode and reportlab are imported on first use: most bot updates never
+# render anything, and worker processes import them on their own
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def gen_qr(cid: str) -> bytes:
+    """Generate QR code for coupon and return it as PNG bytes"""
+    import qrcode
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(cid)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def _qr_matrix(cid: str) -> list:
+    import qrcode
+    qr = qrcode.QRCode(version=1, border=5)
+    qr.add_data(cid)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+def draw_qr(c: "canvas.Canvas", cid: str, x: float, y: float, size: float):
+    """Draw a coupon QR code as vector runs, skipping PNG encode/decode and image embedding"""
+    matrix = _qr_matrix(cid)
+    n = len(matrix)
+    cell = size / n
+    path = c.beginPath()
+    for r, row in enumerate(matrix):
+        top = y + (n - 1 - r) * cell
+        col = 0
+        while col < n:
+            if not row[col]:
+                col += 1
+                continue
+            run = col
+            while col < n and row[col]:
+                col += 1
+            path.rect(x + run * cell, top, (col - run) * cell, cell)
+
+    c.setFillColorRGB(1, 1, 1)
+    c.rect(x, y, size, size, stroke=0, fill=1)
+    c.setFillColorRGB(0, 0, 0)
+    c.drawPath(path, stroke=0, fill=1)
+
+def pdf_name(coupons: list, start: int = 0, total: Optional[int] = None) -> str:
+    name = f"coupons_{coupons[0].recipient}"
+    if total is not None and total > len(coupons):
+        name += f"_{start + 1}-{start + len(coupons)}"
+    return f"{name}.pdf"
+
+def _page_template(c: "canvas.Canvas", w: float, h: float):
+    """Draw the static part of a coupon page once as a reusable form XObject"""
+    from reportlab.lib.units import mm
+    c.beginForm(PAGE_FORM)
+
+    c.setFillColorRGB(0.95, 0.95, 0.95)
+    c.rect(0, 0, w, h, fill=True)
+
+    c.setStrokeColorRGB(0.2, 0.2, 0.2)
+    c.setLineWidth(2)
+    c.rect(20*mm, 20*mm, w - 40*mm, h - 40*mm)
+
+    c.setFillColorRGB(0.2, 0.2, 0.2)
+    c.setFont("Helvetica-Bold", 32)
+    c.drawCentredString(w/2, h - 60*mm, "КУПОН")
+
+    c.setFont("Helvetica", 12)
+    c.drawCentredString(w/2, 40*mm, "Покажите этот купон при оплате")
+    c.drawCentredString(w/2, 30*mm, "Одноразовое использование")
+
+    c.endForm()
+
+def create_pdf(coupons: list, start: int = 0, total: Optional[int] = None) -> bytes:
+    """Create PDF with multiple coupons and return its bytes.
+
+    ``start`` and ``total`` number the pages when ``coupons`` is one chunk
+    of a larger batch.
+    """
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+
+    total = total or len(coupons)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    w, h = A4
+    _page_template(c, w, h)
+
+    for i, cpn in enumerate(coupons, start + 1):
+        c.doForm(PAGE_FORM)
+
+        c.setFillColorRGB(0.2, 0.2, 0.2)
+        c.setFont("Helvetica-Bold", 20)
+        c.drawCentredString(w/2, h - 90*mm, f"Для: {cpn.recipient}")
+
+        c.setFont("Helvetica-Bold", 18)
+        c.drawCentredString(w/2, h - 120*mm, f"Купон #{i} из {total}")
+        c.drawCentredString(w/2, h - 150*mm, f"Код: {cpn.coupon_id}")
+
+        c.setFont("Helvetica", 16)
+        c.drawCentredString(w/2, h - 180*mm, f"Действует до: {cpn.expiry_date}")
+
+        draw_qr(c, cpn.coupon_id, w/2 - 35*mm, h - 260*mm, 70*mm)
+
+        c.setFillColorRGB(0.2, 0.2, 0.2)
+        c.setFont("Helvetica", 10)
+        c.drawCentredString(w/2, 20*mm, f"Страница {i} из {total}")
+
+        c.showPage()
+
+    c.save()
+    return buf.getvalue()
+
+def warm_up():
+    """Import the QR and PDF libraries ahead of the first render"""
+    import qrcode
+    from reportlab.pdfgen import canvas
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Forking the bot with its threads (warm-up, journal compaction) could copy a held lock
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _pool
+
+async def render_pdf(coupons: list) -> bytes:
+    """Render coupons to PDF bytes in the worker process pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), create_pdf, coupons)
+
+async def render_chunks(coupons: list, chunk: int = PDF_CHUNK_PAGES) -> AsyncIterator[Tuple[str, bytes]]:
+    """Render a batch as PDFs of at most ``chunk`` pages, yielding (filename, bytes).
+
+    At most RENDER_WORKERS chunks are in flight, so peak memory depends on
+    the chunk size and not on the batch size.
+    """
+    loop = asyncio.get_running_loop()
+    total = len(coupons)
+    starts = iter(range(0, total, chunk))
+    pending = deque()
+
+    def submit(start: int):
+        part = coupons[start:start + chunk]
+        fut = loop.run_in_executor(_get_pool(), create_pdf, part, start, total)
+        submitted = time.perf_counter()
+        fut.add_done_callback(lambda _: metrics.record("render", time.perf_counter() - submitted))
+        pending.append((start, part, fut))
+
+    for start in islice(starts, RENDER_WORKERS):
+        submit(start)
+    while pending:
+        start, part, fut = pending.popleft()
+        pdf = await fut
+        nxt = next(starts, None)
+        if nxt is not None:
+            submit(nxt)
+        yield pdf_name(part, start, total), pdf
+
+class PdfCache:
+    """LRU of rendered PDF files by coupon set, bounded by their total size.
+
+    A set is keyed by its sorted coupon ids, so asking again for the same
+    coupons costs a lookup. Misses are rendered in the worker processes,
+    and a set that is already being rendered is not rendered twice. A set
+    expected to be larger than the whole cache, at the page size measured
+    so far, is streamed chunk by chunk and not kept, so it costs no more
+    memory than ``render_chunks``. ``evict`` drops
+    every set holding one of the given coupons, e.g. once they are
+    redeemed or expired.
+    """
+
+    def __init__(self, max_bytes: int = int(PDF_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.page_bytes = PAGE_BYTES
+        # key -> (files, size, coupon ids)
+        self._entries = OrderedDict()
+        self._by_coupon = {}
+        self._inflight = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(coupons: list) -> str:
+        ids = "\n".join(sorted(c.coupon_id for c in coupons))
+        return hashlib.blake2s(ids.encode(), digest_size=16).hexdigest()
+
+    async def _render(self, coupons: list) -> List[Tuple[str, bytes]]:
+        return [item async for item in render_chunks(coupons)]
+
+    def _drop(self, key: str):
+        files, size, cids = self._entries.pop(key)
+        self.bytes -= size
+        for cid in cids:
+            keys = self._by_coupon.get(cid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_coupon[cid]
+
+    def _done(self, key: str, coupons: list, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        files = task.result()
+        size = sum(len(pdf) for _, pdf in files)
+        self.page_bytes = size / len(coupons)
+        if size > self.max_bytes or key in self._entries:
+            return
+        cids = [c.coupon_id for c in coupons]
+        self._entries[key] = (files, size, cids)
+        self.bytes += size
+        for cid in cids:
+            self._by_coupon.setdefault(cid, set()).add(key)
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def fits(self, count: int) -> bool:
+        """Whether a set of ``count`` coupons is expected to fit in the cache"""
+        return count * self.page_bytes <= self.max_bytes
+
+    async def files(self, coupons: list) -> AsyncIterator[Tuple[str, bytes]]:
+        """Yield the (filename, bytes) PDFs of a coupon set, rendering them on a miss"""
+        key = self.key(coupons)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            for item in entry[0]:
+                yield item
+            return
+        task = self._inflight.get(key)
+        if task is not None:
+            self.hits += 1
+        elif not self.fits(len(coupons)):
+            self.misses += 1
+            async for item in render_chunks(coupons):
+                yield item
+            return
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._render(list(coupons)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, coupons, t))
+        for item in await asyncio.shield(task):
+            yield item
+
+    def evict(self, coupon_ids: Iterable[str]):
+        """Drop the cached sets that contain any of these coupons"""
+        for cid in coupon_ids:
+            for key in list(self._by_coupon.get(cid, ())):
+                if key in self._entries:
+                    self._drop(key)
+
+cache = PdfCache()
+metrics.register(metrics.Gauge("pdf_cache_hits_total", "PDF re-sends answered from the cache",
+                               lambda: cache.hits, "counter"))
+metrics.register(metrics.Gauge("pdf_cache_misses_total", "PDF re-sends that were rendered",
+                               lambda: cache.misses, "counter"))
+metrics.register(metrics.Gauge("pdf_cache_bytes", "Size of the cached PDFs", lambda: cache.bytes))
+
+def shutdown():
+    """Stop the render worker processes"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
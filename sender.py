@@ -0,0 +1,209 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextvars import ContextVar
+from typing import Dict, Iterable
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+import metrics
+
+# Telegram's flood limits: about 30 messages per second overall, one per
+# second in a chat and 20 per minute in a group. A rate of 0 disables a limit.
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))
+CHAT_RATE = float(os.getenv("CHAT_RATE", "1"))
+CHAT_BURST = int(os.getenv("CHAT_BURST", "3"))
+GROUP_RATE = float(os.getenv("GROUP_RATE", str(20 / 60)))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "50"))
+
+# Idle chat buckets are dropped once this many are tracked
+CHAT_BUCKETS = 10000
+
+# Priority lanes, served in this order
+URGENT, REPLY, BULK = range(3)
+
+# Lane of the requests made by the current task
+lane: ContextVar[int] = ContextVar("lane", default=REPLY)
+
+class TokenBucket:
+    """Allows ``rate`` events per second with bursts of up to ``burst``"""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp", "blocked_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until the next event is allowed"""
+        wait = max(0.0, self.blocked_until - now)
+        if self.rate <= 0:
+            return wait
+        self._refill(now)
+        return max(wait, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        """Allow nothing for ``seconds``, e.g. after a flood-wait error"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        if self.rate <= 0:
+            return self.blocked_until <= now
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+class OutboundSender(BaseRequestMiddleware):
+    """Session middleware pacing every API call that targets a chat.
+
+    A call first waits for its chat's bucket, holding the chat's lock so
+    messages to one chat keep their order, then queues for the global
+    bucket. The global queue is served by lane: chats in ``urgent_chats``
+    first, other replies next and broadcasts last, so admin replies never
+    wait behind a bulk notification. A flood-wait error pauses the chat and
+    the global bucket for ``retry_after`` and the call is sent again.
+    """
+
+    def __init__(self, rate: float = SEND_RATE, chat_rate: float = CHAT_RATE, chat_burst: int = CHAT_BURST,
+                 group_rate: float = GROUP_RATE, retries: int = SEND_RETRIES, urgent_chats: Iterable[int] = ()):
+        # Evenly spaced, leaving Telegram's burst allowance as headroom for network jitter
+        self.bucket = TokenBucket(rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.urgent_chats = set(urgent_chats)
+        self.sent = 0
+        self.retried = 0
+        self._chats = {}
+        self._locks = {}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._pump = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS:
+                now = time.monotonic()
+                for cid in [c for c, b in self._chats.items() if c not in self._locks and b.idle(now)]:
+                    del self._chats[cid]
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _serve(self):
+        """Hand out global tokens to the waiting calls, best lane first"""
+        while self._waiting:
+            wait = self.bucket.delay(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, fut = heapq.heappop(self._waiting)
+            if fut.done():
+                continue
+            self.bucket.take()
+            fut.set_result(None)
+
+    async def _acquire(self, chat: TokenBucket, priority: int):
+        while True:
+            wait = chat.delay(time.monotonic())
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._serve())
+        await fut
+        # Taken when the call goes out, so time spent queued counts as spacing
+        chat.take()
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            # Calls that are not about one chat, and @channel usernames
+            return await make_request(bot, method)
+
+        priority = lane.get()
+        if priority == REPLY and chat_id in self.urgent_chats:
+            priority = URGENT
+        chat = self._chat_bucket(chat_id)
+        lock = self._locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                for attempt in itertools.count():
+                    with metrics.phase("send_wait"):
+                        await self._acquire(chat, priority)
+                    try:
+                        with metrics.phase("send"):
+                            resp = await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        if attempt >= self.retries:
+                            raise
+                        self.retried += 1
+                        logging.warning(f"Flood wait {e.retry_after}s on {type(method).__name__} to {chat_id}")
+                        now = time.monotonic()
+                        chat.pause(now, e.retry_after)
+                        self.bucket.pause(now, e.retry_after)
+                        continue
+                    self.sent += 1
+                    return resp
+        finally:
+            lock[1] -= 1
+            if not lock[1]:
+                del self._locks[chat_id]
+
+    def report(self) -> dict:
+        return {"sent": self.sent, "retried": self.retried, "queued": len(self._waiting)}
+
+async def send_bulk(bot, messages: Dict[int, str], concurrency: int = BROADCAST_CONCURRENCY) -> tuple:
+    """Send each chat its message in the bulk lane, returning (delivered, failed).
+
+    Chats that blocked the bot or no longer exist count as failed.
+    """
+    token = lane.set(BULK)
+    sem = asyncio.Semaphore(concurrency)
+    delivered = failed = 0
+
+    async def send(chat_id: int, text: str):
+        nonlocal delivered, failed
+        async with sem:
+            try:
+                await bot.send_message(chat_id, text)
+                delivered += 1
+            except TelegramAPIError as e:
+                failed += 1
+                logging.info(f"Notification to {chat_id} failed: {str(e)}")
+
+    try:
+        # Tasks copy the context here, so they all run in the bulk lane
+        await asyncio.gather(*(send(c, t) for c, t in messages.items()))
+    finally:
+        lane.reset(token)
+    return delivered, failed
+
+async def broadcast(bot, chat_ids: Iterable[int], text: str,
+                    concurrency: int = BROADCAST_CONCURRENCY) -> tuple:
+    """Send the same text to every chat in the bulk lane, returning (delivered, failed)"""
+    return await send_bulk(bot, dict.fromkeys(chat_ids, text), concurrency)
@@ -0,0 +1,413 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from keyset import Cursor
+from records import ALREADY_USED, EXPIRED, NOT_FOUND, REDEEMED, Coupon, RedeemResult
+from stats import DAY, StatsAggregator
+from archive import UsedArchive
+from store import COUPONS_FILE, USED_FILE, CNTR_FILE, EXPIRED_FILE, JOURNAL_FILE, META_FILE, JournalStore
+
+DB_FILE = os.getenv("SQLITE_PATH", "coupons.db")
+BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "10"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coupons (
+    coupon_id TEXT PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    user_id INTEGER,
+    expiry INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    used_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_coupons_rcpt_used ON coupons(recipient, used_at, coupon_id);
+CREATE INDEX IF NOT EXISTS idx_coupons_rcpt_created ON coupons(recipient, used_at, created_at, coupon_id);
+CREATE INDEX IF NOT EXISTS idx_coupons_user ON coupons(user_id);
+CREATE INDEX IF NOT EXISTS idx_coupons_used_expiry ON coupons(used_at, expiry);
+CREATE INDEX IF NOT EXISTS idx_coupons_used_order ON coupons(used_at, coupon_id);
+CREATE TABLE IF NOT EXISTS expired_coupons (
+    coupon_id TEXT PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    user_id INTEGER,
+    expiry INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    used_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_expired_user ON expired_coupons(user_id);
+CREATE TABLE IF NOT EXISTS counters (
+    recipient TEXT PRIMARY KEY,
+    cnt INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+COLUMNS = "coupon_id, recipient, user_id, expiry, created_at, used_at"
+
+def _to_row(cpn: Coupon) -> tuple:
+    return (cpn.coupon_id, cpn.recipient, cpn.user_id, cpn.expiry, cpn.created, cpn.redeemed)
+
+def _to_coupon(row: tuple) -> Coupon:
+    cid, rcpt, uid, expiry, created, redeemed = row
+    return Coupon(cid, rcpt, expiry, created, redeemed, uid)
+
+def _keyset(col: str, cursor: Optional[Cursor], back: bool, desc: bool) -> tuple:
+    """Build the cursor condition, ORDER BY and params of a keyset page query.
+
+    Returns the rows in scan order; the page is in display order when
+    ``back`` is False and has to be reversed otherwise.
+    """
+    ascending = back == desc
+    order = f"{col}, coupon_id" if ascending else f"{col} DESC, coupon_id DESC"
+    if cursor is None:
+        return "", order, ()
+    op = ">" if ascending else "<"
+    return f" AND ({col}, coupon_id) {op} (?, ?)", order, tuple(cursor)
+
+class SqliteStore:
+    """Coupon store backed by a local SQLite database in WAL mode.
+
+    Active and used coupons share one table (``used_at`` is NULL while a
+    coupon is active), so nothing is held in memory and every handler
+    lookup is an indexed query. Coupons that expired unredeemed are moved
+    to ``expired_coupons``, which has the same columns.
+
+    Several processes may share one database. Writes take SQLite's write
+    lock up front and wait up to ``BUSY_TIMEOUT`` for it, and the in-memory
+    stats are rebuilt when ``PRAGMA data_version`` shows that another
+    connection has committed since they were loaded.
+    """
+
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        if self._meta("migrated") is None:
+            self.migrate_from_json()
+        self._data_version = None
+        self._load_stats()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction holding the database write lock from its first statement (lock held).
+
+        A deferred transaction that reads before writing fails right away
+        with SQLITE_BUSY if another process commits in between, instead of
+        waiting for the lock.
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            yield
+
+    @property
+    def stats(self) -> StatsAggregator:
+        """Stats of the whole database, reloaded if another process wrote to it"""
+        with self._lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._load_stats()
+        return self._stats
+
+    def _load_stats(self):
+        since = int(time.time() - DAY)
+        stats = StatsAggregator()
+        with self._lock:
+            with self._conn:
+                # One read transaction, so the three queries see the same snapshot
+                self._conn.execute("BEGIN")
+                active = self._conn.execute(
+                    "SELECT recipient, expiry, COUNT(*) FROM coupons WHERE used_at IS NULL GROUP BY recipient, expiry "
+                    "UNION ALL SELECT recipient, expiry, COUNT(*) FROM expired_coupons GROUP BY recipient, expiry"
+                ).fetchall()
+                cntrs = dict(self._conn.execute("SELECT recipient, cnt FROM counters"))
+                recent = [r[0] for r in self._conn.execute("SELECT used_at FROM coupons WHERE used_at >= ?", (since,))]
+                self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            stats.load(active, cntrs, recent)
+            self._stats = stats
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return [_to_coupon(r) for r in self._conn.execute(sql, params)]
+
+    def migrate_from_json(self, coupons_file: str = COUPONS_FILE, used_file: str = USED_FILE,
+                          cntr_file: str = CNTR_FILE, expired_file: str = EXPIRED_FILE,
+                          meta_file: str = META_FILE, journal_file: str = JOURNAL_FILE,
+                          archive: Optional[UsedArchive] = None):
+        """One-shot import of the JSON store into an empty database.
+
+        The JSON store is opened read-only, so records still only in its
+        journal are replayed first, and redemptions it has archived are
+        imported along with the hot ones.
+        """
+        src = JournalStore(coupons_file, used_file, cntr_file, journal_file, meta_file,
+                           archive=archive, expired_file=expired_file, read_only=True)
+        with self._lock:
+            with self._transaction():
+                if self._meta("migrated") is not None:
+                    # Another process sharing the database got there first
+                    return
+                active = self._conn.executemany(
+                    f"INSERT OR IGNORE INTO coupons ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                    (_to_row(c) for c in src.iter_active())
+                ).rowcount
+                used = self._conn.executemany(
+                    f"INSERT OR REPLACE INTO coupons ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                    (_to_row(c) for c in src.iter_used())
+                ).rowcount
+                expired = self._conn.executemany(
+                    f"INSERT OR IGNORE INTO expired_coupons ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                    (_to_row(c) for c in src.iter_expired())
+                ).rowcount
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO counters (recipient, cnt) VALUES (?, ?)",
+                    src.cntrs.items()
+                )
+                if "next_serial" in src.meta:
+                    # Signed codes already handed out must not be minted again
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('next_serial', ?)",
+                        (str(src.meta["next_serial"]),)
+                    )
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+        logging.info(f"Migrated {active} active, {used} used and {expired} expired coupons into {self.path}")
+
+    def add(self, cpns: list):
+        """Persist newly created coupons"""
+        with self._lock:
+            with self._transaction():
+                self._conn.executemany(
+                    f"INSERT INTO coupons ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                    [_to_row(c) for c in cpns]
+                )
+            for cpn in cpns:
+                self._stats.on_create(cpn)
+
+    def redeem(self, cid: str, now: int) -> RedeemResult:
+        """Atomically check and redeem a coupon"""
+        return self.redeem_many([cid], now)[0]
+
+    def redeem_many(self, cids: list, now: int) -> list:
+        """Atomically check and redeem a batch of coupons in one transaction.
+
+        The conditional UPDATE is the compare-and-set: it only matches while
+        the coupon is still active and unexpired, and the counter bumps are
+        committed in the same transaction. Other processes sharing the
+        database serialize on SQLite's write lock.
+        """
+        results = []
+        redeemed = []
+        with self._lock:
+            with self._transaction():
+                for cid in cids:
+                    cur = self._conn.execute(
+                        "UPDATE coupons SET used_at = ? WHERE coupon_id = ? AND used_at IS NULL AND expiry >= ?",
+                        (now, cid, now)
+                    )
+                    row = self._conn.execute(f"SELECT {COLUMNS} FROM coupons WHERE coupon_id = ?", (cid,)).fetchone()
+                    if row is None:
+                        row = self._conn.execute(
+                            f"SELECT {COLUMNS} FROM expired_coupons WHERE coupon_id = ?", (cid,)
+                        ).fetchone()
+                    if row is None:
+                        results.append(RedeemResult(NOT_FOUND))
+                        continue
+                    cpn = _to_coupon(row)
+                    if cur.rowcount == 1:
+                        self._conn.execute(
+                            "INSERT INTO counters (recipient, cnt) VALUES (?, 1) "
+                            "ON CONFLICT(recipient) DO UPDATE SET cnt = cnt + 1",
+                            (cpn.recipient,)
+                        )
+                        status = REDEEMED
+                        redeemed.append(cpn)
+                    elif cpn.redeemed is not None:
+                        status = ALREADY_USED
+                    else:
+                        status = EXPIRED
+                    count_row = self._conn.execute(
+                        "SELECT cnt FROM counters WHERE recipient = ?", (cpn.recipient,)
+                    ).fetchone()
+                    results.append(RedeemResult(status, cpn, count_row[0] if count_row else 0))
+            for cpn in redeemed:
+                self._stats.on_redeem(cpn)
+        return results
+
+    def reserve_serials(self, n: int) -> int:
+        """Allocate ``n`` consecutive coupon serials and return the first one"""
+        with self._lock:
+            with self._transaction():
+                self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('next_serial', '1')")
+                self._conn.execute(
+                    "UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = 'next_serial'", (n,)
+                )
+                end = int(self._conn.execute("SELECT value FROM meta WHERE key = 'next_serial'").fetchone()[0])
+        return end - n
+
+    def delete(self, cids: list):
+        """Remove active coupons"""
+        removed = []
+        with self._lock:
+            with self._transaction():
+                for cid in cids:
+                    row = self._conn.execute(
+                        f"SELECT {COLUMNS} FROM coupons WHERE coupon_id = ? AND used_at IS NULL", (cid,)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    self._conn.execute("DELETE FROM coupons WHERE coupon_id = ?", (cid,))
+                    removed.append(_to_coupon(row))
+            for cpn in removed:
+                self._stats.on_delete(cpn)
+
+    def next_expiry(self) -> Optional[int]:
+        """Return the earliest expiry among active coupons"""
+        with self._lock:
+            return self._conn.execute("SELECT MIN(expiry) FROM coupons WHERE used_at IS NULL").fetchone()[0]
+
+    def expire_due(self, now: float) -> list:
+        """Move the active coupons that expired before ``now`` to expired_coupons and return them.
+
+        Both statements range-scan the (used_at, expiry) index, so a sweep
+        reads only the coupons that expired. Concurrent sweeps of other processes
+        serialize on the write lock and find nothing left to move.
+        """
+        where = "used_at IS NULL AND expiry < ?"
+        with self._lock:
+            with self._transaction():
+                rows = self._conn.execute(f"SELECT {COLUMNS} FROM coupons WHERE {where}", (now,)).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        f"INSERT OR REPLACE INTO expired_coupons ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", rows
+                    )
+                    self._conn.execute(f"DELETE FROM coupons WHERE {where}", (now,))
+        return [_to_coupon(r) for r in rows]
+
+    def get(self, cid: str) -> Optional[Coupon]:
+        """Return an active coupon by id"""
+        rows = self._query(f"SELECT {COLUMNS} FROM coupons WHERE coupon_id = ? AND used_at IS NULL", (cid,))
+        return rows[0] if rows else None
+
+    def find(self, cid: str) -> Optional[Coupon]:
+        """Return a coupon by id whether it is active, expired or used"""
+        rows = self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE coupon_id = ? "
+            f"UNION ALL SELECT {COLUMNS} FROM expired_coupons WHERE coupon_id = ?", (cid, cid)
+        )
+        return rows[0] if rows else None
+
+    def has_active(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM coupons WHERE used_at IS NULL LIMIT 1").fetchone() is not None
+
+    def active_by_recipient(self, rcpt: str) -> list:
+        return self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE recipient = ? AND used_at IS NULL ORDER BY created_at",
+            (rcpt,)
+        )
+
+    def active_count(self, rcpt: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM coupons WHERE recipient = ? AND used_at IS NULL", (rcpt,)
+            ).fetchone()[0]
+
+    def holders(self, rcpt: str) -> set:
+        """Return the users holding active coupons of a recipient"""
+        with self._lock:
+            return {r[0] for r in self._conn.execute(
+                "SELECT DISTINCT user_id FROM coupons WHERE recipient = ? AND used_at IS NULL AND user_id IS NOT NULL",
+                (rcpt,)
+            )}
+
+    def _page(self, where: str, params: tuple, col: str, limit: int,
+              cursor: Optional[Cursor], back: bool, desc: bool) -> list:
+        cond, order, cur_params = _keyset(col, cursor, back, desc)
+        rows = self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE {where}{cond} ORDER BY {order} LIMIT ?",
+            params + cur_params + (limit,)
+        )
+        if back:
+            rows.reverse()
+        return rows
+
+    def active_page(self, rcpt: str, limit: int, cursor: Optional[Cursor] = None,
+                    back: bool = False) -> list:
+        """Return a page of a recipient's active coupons, oldest first"""
+        return self._page("recipient = ? AND used_at IS NULL", (rcpt,), "created_at",
+                          limit, cursor, back, desc=False)
+
+    def used_page(self, limit: int, cursor: Optional[Cursor] = None, back: bool = False) -> list:
+        """Return a page of the redemption history, newest first"""
+        return self._page("used_at IS NOT NULL", (), "used_at", limit, cursor, back, desc=True)
+
+    def used_by_recipient(self, rcpt: str, limit: Optional[int] = None) -> list:
+        """Return a recipient's used coupons, oldest first, optionally only the last ``limit``"""
+        rows = self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE recipient = ? AND used_at IS NOT NULL "
+            "ORDER BY used_at DESC, coupon_id DESC LIMIT ?",
+            (rcpt, -1 if limit is None else limit)
+        )
+        rows.reverse()
+        return rows
+
+    def by_user(self, uid: int) -> list:
+        return self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE user_id = ? AND used_at IS NULL ORDER BY created_at",
+            (uid,)
+        )
+
+    def used_by_user(self, uid: int) -> list:
+        return self._query(
+            f"SELECT {COLUMNS} FROM coupons WHERE user_id = ? AND used_at IS NOT NULL ORDER BY used_at",
+            (uid,)
+        )
+
+    def expired_by_user(self, uid: int) -> list:
+        return self._query(
+            f"SELECT {COLUMNS} FROM expired_coupons WHERE user_id = ? ORDER BY expiry",
+            (uid,)
+        )
+
+    def used_count(self, rcpt: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT cnt FROM counters WHERE recipient = ?", (rcpt,)).fetchone()
+        return row[0] if row else 0
+
+    def _iter(self, sql: str) -> Iterator[Coupon]:
+        cur = self._conn.cursor()
+        cur.arraysize = 500
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            for r in rows:
+                yield _to_coupon(r)
+
+    def iter_active(self) -> Iterator[Coupon]:
+        """Stream active coupons without loading them all"""
+        return self._iter(f"SELECT {COLUMNS} FROM coupons WHERE used_at IS NULL")
+
+    def iter_expired(self) -> Iterator[Coupon]:
+        return self._iter(f"SELECT {COLUMNS} FROM expired_coupons")
+
+    def iter_used(self) -> Iterator[Coupon]:
+        """Stream used coupons in redemption order"""
+        return self._iter(f"SELECT {COLUMNS} FROM coupons WHERE used_at IS NOT NULL ORDER BY used_at")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
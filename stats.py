@@ -0,0 +1,102 @@
+import heapq
+import threading
+from collections import Counter, defaultdict, deque
+
+from records import Coupon
+
+DAY = 86400
+BUCKET = 60
+
+class StatsAggregator:
+    """Incrementally maintained coupon statistics for the stats panel.
+
+    Active coupons are counted per (expiry, recipient) bucket; distinct expiry
+    moments sit in a min-heap, so moving coupons from active to expired only
+    touches the buckets that actually expired. Redemptions of the last day are
+    kept in per-minute buckets with a running total.
+    """
+
+    def __init__(self):
+        self.per_rcpt = defaultdict(lambda: {"active": 0, "used": 0, "expired": 0})
+        self._lock = threading.Lock()
+        self._by_expiry = defaultdict(Counter)
+        self._heap = []
+        self._swept = 0
+        self._recent = deque()
+        self._recent_total = 0
+
+    def _is_expired(self, ts: int) -> bool:
+        return ts < self._swept
+
+    def _count_active(self, rcpt: str, ts: int, delta: int):
+        if self._is_expired(ts):
+            self.per_rcpt[rcpt]["expired"] += delta
+            return
+        self.per_rcpt[rcpt]["active"] += delta
+        if ts not in self._by_expiry:
+            heapq.heappush(self._heap, ts)
+        self._by_expiry[ts][rcpt] += delta
+
+    def _count_redemption(self, ts: int):
+        minute = ts // BUCKET
+        if not self._recent or self._recent[-1][0] < minute:
+            self._recent.append([minute, 1])
+        else:
+            # Same minute, or a stamp slightly out of order: fold into the newest bucket
+            self._recent[-1][1] += 1
+        self._recent_total += 1
+
+    def on_create(self, cpn: Coupon):
+        with self._lock:
+            self._count_active(cpn.recipient, cpn.expiry, 1)
+
+    def on_delete(self, cpn: Coupon):
+        with self._lock:
+            self._count_active(cpn.recipient, cpn.expiry, -1)
+
+    def on_redeem(self, cpn: Coupon):
+        with self._lock:
+            self._count_active(cpn.recipient, cpn.expiry, -1)
+            self.per_rcpt[cpn.recipient]["used"] += 1
+            self._count_redemption(cpn.redeemed)
+
+    def load(self, active_counts, cntrs: dict, recent_used):
+        """Seed the counters at startup.
+
+        ``active_counts`` yields (recipient, expiry epoch, count) for active
+        coupons and ``recent_used`` yields the redemption epochs of the last day.
+        """
+        with self._lock:
+            for rcpt, ts, cnt in active_counts:
+                self._count_active(rcpt, ts, cnt)
+            for rcpt, cnt in cntrs.items():
+                self.per_rcpt[rcpt]["used"] = cnt
+            for ts in sorted(recent_used):
+                self._count_redemption(ts)
+
+    def _advance(self, now: float):
+        """Move every bucket whose expiry has passed from active to expired"""
+        while self._heap and self._heap[0] < now:
+            ts = heapq.heappop(self._heap)
+            for rcpt, cnt in self._by_expiry.pop(ts).items():
+                self.per_rcpt[rcpt]["active"] -= cnt
+                self.per_rcpt[rcpt]["expired"] += cnt
+        self._swept = max(self._swept, now)
+
+        horizon = (now - DAY) // BUCKET
+        while self._recent and self._recent[0][0] < horizon:
+            self._recent_total -= self._recent.popleft()[1]
+
+    def report(self, now: float) -> tuple:
+        """Return (totals, per-recipient counters, redemptions in the last 24h)"""
+        with self._lock:
+            self._advance(now)
+            totals = {"active": 0, "used": 0, "expired": 0}
+            per_rcpt = {}
+            for rcpt, data in self.per_rcpt.items():
+                if not any(data.values()):
+                    continue
+                per_rcpt[rcpt] = dict(data)
+                for key in totals:
+                    totals[key] += data[key]
+            return totals, per_rcpt, self._recent_total
@@ -0,0 +1,598 @@
+import os
+import json
+import heapq
+import bisect
+import logging
+import shutil
+import threading
+from collections import Counter, defaultdict
+import time
+from typing import Iterator, Optional
+
+from archive import HOT_DAYS, UsedArchive, hot_cutoff
+from keyset import Cursor, SortedIndex
+from records import ALREADY_USED, EXPIRED, NOT_FOUND, REDEEMED, Coupon, RedeemResult
+from stats import DAY, StatsAggregator
+
+COUPONS_FILE = "coupons.json"
+USED_FILE = "used_coupons.json"
+EXPIRED_FILE = "expired_coupons.json"
+CNTR_FILE = "counters.json"
+META_FILE = "store_meta.json"
+JOURNAL_FILE = "coupons.journal"
+
+STORE_BACKEND = os.getenv("STORE_BACKEND", "json")
+
+COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "1000"))
+
+def load_json(path: str) -> dict:
+    """Load a JSON snapshot, returning an empty dict if it is missing or broken"""
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            logging.error(f"Snapshot {path} is corrupted, starting from empty")
+            return {}
+    return {}
+
+def lock_exclusive(path: str):
+    """Open ``path`` and lock it for this process without waiting, raising RuntimeError if another holds it"""
+    f = open(path, 'a')
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        raise RuntimeError(f"{path} is locked: another process is writing the JSON store, stop it first")
+    return f
+
+def dump_json(path: str, data: dict):
+    """Atomically replace a JSON snapshot via a fsynced temp file"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class JournalStore:
+    """Coupon store kept in memory, persisted as JSON snapshots plus an append-only journal.
+
+    Every mutation is appended to the journal as one JSON line and fsynced
+    before it is applied. Records are idempotent (they carry the resulting
+    values, not deltas), so replaying a journal over a snapshot that already
+    contains some of its records is harmless. Once the journal grows past
+    ``compact_every`` records it is rotated and folded into the snapshots
+    on a background thread.
+
+    Only redemptions of the last ``hot_days`` (rounded down to a month
+    boundary) stay in memory and in the used snapshot. Compaction moves older
+    ones into the monthly segments of a ``UsedArchive``, which history
+    queries read lazily once they page past the hot window. The compaction
+    thread only writes files; the archived coupons leave memory with the
+    next write, so the readers never race it.
+
+    Unredeemed coupons past their expiry are moved out of the active set by
+    ``expire_due``. Active coupons are bucketed by expiry moment and the
+    distinct moments kept in a min-heap, so a sweep only touches the
+    coupons that actually expired.
+
+    A single process may write the store; it holds a lock on
+    ``<journal>.lock`` until ``close``. With ``read_only`` the files are
+    loaded without the lock and never written: no journal handle, no
+    truncation of a torn tail (it may be a record being appended) and no
+    compaction on close, so tools can read next to the running bot.
+    """
+
+    def __init__(self, coupons_file: str = COUPONS_FILE, used_file: str = USED_FILE,
+                 cntr_file: str = CNTR_FILE, journal_file: str = JOURNAL_FILE,
+                 meta_file: str = META_FILE, compact_every: int = COMPACT_EVERY,
+                 archive: Optional[UsedArchive] = None, hot_days: int = HOT_DAYS,
+                 expired_file: str = EXPIRED_FILE, read_only: bool = False):
+        self.read_only = read_only
+        self._lockf = None if read_only else lock_exclusive(f"{journal_file}.lock")
+        self.coupons_file = coupons_file
+        self.used_file = used_file
+        self.expired_file = expired_file
+        self.cntr_file = cntr_file
+        self.journal_file = journal_file
+        self.meta_file = meta_file
+        self.compact_every = compact_every
+        self.archive = archive or UsedArchive()
+        self.hot_days = hot_days
+
+        self.coupons = {cid: Coupon.from_dict(d) for cid, d in load_json(coupons_file).items()}
+        self.used = {cid: Coupon.from_dict(d) for cid, d in load_json(used_file).items()}
+        self.expired = {cid: Coupon.from_dict(d) for cid, d in load_json(expired_file).items()}
+        self.cntrs = load_json(cntr_file)
+        self.meta = load_json(meta_file)
+
+        # Secondary indexes: recipient -> keys sorted by creation / redemption
+        # time, user_id -> ordered set of coupon ids, plus all used coupons
+        # sorted by redemption time for the history view
+        self._active_by_rcpt = defaultdict(SortedIndex)
+        self._used_by_rcpt = defaultdict(SortedIndex)
+        self._active_by_user = defaultdict(dict)
+        self._used_by_user = defaultdict(dict)
+        self._expired_by_user = defaultdict(dict)
+        self._used_order = SortedIndex()
+        # Expiry moment -> ids of the active coupons expiring then, and a
+        # min-heap of those moments (stale ones are skipped when popped)
+        self._by_expiry = defaultdict(dict)
+        self._deadlines = []
+        for cpn in self.coupons.values():
+            self._index_active(cpn)
+        for cpn in self.used.values():
+            self._index_used(cpn)
+        for cpn in self.expired.values():
+            self._index_expired(cpn)
+
+        self._lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        # Batches of cold redemptions the compactor has archived
+        self._archived = []
+        self.stats: Optional[StatsAggregator] = None
+
+        # A rotated journal is only left behind if compaction was interrupted
+        if os.path.exists(self._rotated_file):
+            self._replay(self._rotated_file)
+        self._pending = self._replay(journal_file)
+        self._jf = None if read_only else open(journal_file, 'a', encoding='utf-8')
+
+        since = time.time() - DAY
+        self.stats = StatsAggregator()
+        unused = list(self.coupons.values()) + list(self.expired.values())
+        self.stats.load(
+            ((rcpt, ts, cnt) for (rcpt, ts), cnt in
+             Counter((c.recipient, c.expiry) for c in unused).items()),
+            self.cntrs,
+            (c.redeemed for c in self.used.values() if c.redeemed >= since)
+        )
+
+    @property
+    def _rotated_file(self) -> str:
+        return f"{self.journal_file}.old"
+
+    @staticmethod
+    def _index(cpn: Coupon, key: Cursor, by_rcpt: dict, by_user: dict):
+        by_rcpt[cpn.recipient].add(key)
+        if cpn.user_id is not None:
+            by_user[cpn.user_id][cpn.coupon_id] = None
+
+    @staticmethod
+    def _unindex(cpn: Coupon, key: Cursor, by_rcpt: dict, by_user: dict):
+        keys = by_rcpt.get(cpn.recipient)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del by_rcpt[cpn.recipient]
+        ids = by_user.get(cpn.user_id)
+        if ids is not None:
+            ids.pop(cpn.coupon_id, None)
+            if not ids:
+                del by_user[cpn.user_id]
+
+    def _index_active(self, cpn: Coupon):
+        self._index(cpn, (cpn.created, cpn.coupon_id), self._active_by_rcpt, self._active_by_user)
+        if cpn.expiry not in self._by_expiry:
+            heapq.heappush(self._deadlines, cpn.expiry)
+        self._by_expiry[cpn.expiry][cpn.coupon_id] = None
+
+    def _index_expired(self, cpn: Coupon):
+        if cpn.user_id is not None:
+            self._expired_by_user[cpn.user_id][cpn.coupon_id] = None
+
+    def _index_used(self, cpn: Coupon):
+        key = (cpn.redeemed, cpn.coupon_id)
+        self._index(cpn, key, self._used_by_rcpt, self._used_by_user)
+        self._used_order.add(key)
+
+    def _unindex_used(self, cpn: Coupon):
+        key = (cpn.redeemed, cpn.coupon_id)
+        self._unindex(cpn, key, self._used_by_rcpt, self._used_by_user)
+        self._used_order.discard(key)
+
+    def _drop_active(self, cid: str) -> Optional[Coupon]:
+        cpn = self.coupons.pop(cid, None)
+        if cpn is not None:
+            self._unindex(cpn, (cpn.created, cpn.coupon_id), self._active_by_rcpt, self._active_by_user)
+            ids = self._by_expiry.get(cpn.expiry)
+            if ids is not None:
+                ids.pop(cid, None)
+                if not ids:
+                    del self._by_expiry[cpn.expiry]
+        return cpn
+
+    def _apply(self, rec: dict, cpns: Optional[list] = None):
+        """Apply one journal record to the in-memory state, its indexes and stats.
+
+        Live mutations pass the already built records as ``cpns``; on replay
+        they are decoded from the journal. Stats are seeded in bulk after
+        replay, so they are only fed live records.
+        """
+        op = rec["op"]
+        if op == "create":
+            if cpns is None:
+                cpns = [Coupon.from_dict(d) for d in rec["coupons"]]
+            for cpn in cpns:
+                old = self._drop_active(cpn.coupon_id)
+                self.coupons[cpn.coupon_id] = cpn
+                self._index_active(cpn)
+                if self.stats is not None:
+                    if old is not None:
+                        self.stats.on_delete(old)
+                    self.stats.on_create(cpn)
+        elif op == "redeem":
+            if cpns is None:
+                cpns = [Coupon.from_dict(d) for d in rec["coupons"]]
+            for cpn in cpns:
+                if self._drop_active(cpn.coupon_id) is not None and self.stats is not None:
+                    self.stats.on_redeem(cpn)
+                old = self.used.get(cpn.coupon_id)
+                if old is not None:
+                    self._unindex_used(old)
+                self.used[cpn.coupon_id] = cpn
+                self._index_used(cpn)
+            self.cntrs.update(rec["counts"])
+        elif op == "serial":
+            self.meta["next_serial"] = max(self.meta.get("next_serial", 1), rec["next"])
+        elif op == "delete":
+            for cid in rec["ids"]:
+                cpn = self._drop_active(cid)
+                if cpn is not None and self.stats is not None:
+                    self.stats.on_delete(cpn)
+        elif op == "expire":
+            # Stats already count coupons as expired once their expiry passes
+            for cid in rec["ids"]:
+                cpn = self._drop_active(cid)
+                if cpn is not None:
+                    self.expired[cid] = cpn
+                    self._index_expired(cpn)
+        else:
+            logging.warning(f"Unknown journal op {op!r}, skipping")
+
+    def _replay(self, path: str) -> int:
+        """Replay a journal file and cut off a torn tail left by a crash"""
+        if not os.path.exists(path):
+            return 0
+
+        cnt = 0
+        good = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._apply(rec)
+                good += len(line)
+                cnt += 1
+
+        if good != os.path.getsize(path) and not self.read_only:
+            logging.warning(f"Journal {path} has a torn tail after {cnt} records, truncating")
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        return cnt
+
+    def _drop_archived(self):
+        """Drop redemptions the compactor has archived from memory (lock held)"""
+        while self._archived:
+            for cpn in self._archived.pop():
+                if self.used.get(cpn.coupon_id) is cpn:
+                    del self.used[cpn.coupon_id]
+                    self._unindex_used(cpn)
+
+    def _append(self, rec: dict, cpns: Optional[list] = None):
+        """Durably append a record to the journal and apply it"""
+        if self.read_only:
+            raise RuntimeError("The store was opened read-only")
+        self._drop_archived()
+        self._jf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._jf.flush()
+        os.fsync(self._jf.fileno())
+        self._apply(rec, cpns)
+        self._pending += 1
+        if self._pending >= self.compact_every:
+            self._start_compaction()
+
+    def add(self, cpns: list):
+        """Persist newly created coupons"""
+        with self._lock:
+            self._append({"op": "create", "coupons": [c.to_dict() for c in cpns]}, cpns)
+
+    def redeem(self, cid: str, now: int) -> RedeemResult:
+        """Atomically check and redeem a coupon"""
+        return self.redeem_many([cid], now)[0]
+
+    def redeem_many(self, cids: list, now: int) -> list:
+        """Atomically check and redeem a batch of coupons, one result per id.
+
+        The state checks, the used records, the counter bumps and the removal
+        from the active set happen under the store lock and are committed as
+        one journal record, so concurrent attempts on the same coupon see
+        exactly one REDEEMED. A repeated id in the batch is ALREADY_USED.
+        """
+        results = []
+        redeemed = {}
+        counts = {}
+        with self._lock:
+            for cid in cids:
+                cpn = self.coupons.get(cid)
+                if cpn is None and cid in self.expired:
+                    cpn = self.expired[cid]
+                    count = counts.get(cpn.recipient, self.cntrs.get(cpn.recipient, 0))
+                    results.append(RedeemResult(EXPIRED, cpn, count))
+                    continue
+                if cpn is None or cid in redeemed:
+                    used_cpn = redeemed.get(cid) or self.used.get(cid)
+                    if used_cpn is None:
+                        results.append(RedeemResult(NOT_FOUND))
+                    else:
+                        count = counts.get(used_cpn.recipient, self.cntrs.get(used_cpn.recipient, 0))
+                        results.append(RedeemResult(ALREADY_USED, used_cpn, count))
+                    continue
+                if cpn.is_expired(now):
+                    count = counts.get(cpn.recipient, self.cntrs.get(cpn.recipient, 0))
+                    results.append(RedeemResult(EXPIRED, cpn, count))
+                    continue
+
+                used_cpn = cpn.redeem(now)
+                count = counts.get(cpn.recipient, self.cntrs.get(cpn.recipient, 0)) + 1
+                counts[cpn.recipient] = count
+                redeemed[cid] = used_cpn
+                results.append(RedeemResult(REDEEMED, used_cpn, count))
+
+            if redeemed:
+                self._append({
+                    "op": "redeem",
+                    "coupons": [c.to_dict() for c in redeemed.values()],
+                    "counts": counts
+                }, list(redeemed.values()))
+        return results
+
+    def reserve_serials(self, n: int) -> int:
+        """Allocate ``n`` consecutive coupon serials and return the first one"""
+        with self._lock:
+            start = self.meta.get("next_serial", 1)
+            self._append({"op": "serial", "next": start + n})
+            return start
+
+    def delete(self, cids: list):
+        """Remove active coupons"""
+        with self._lock:
+            self._append({"op": "delete", "ids": list(cids)})
+
+    def next_expiry(self) -> Optional[int]:
+        """Return the earliest expiry among active coupons"""
+        with self._lock:
+            while self._deadlines and self._deadlines[0] not in self._by_expiry:
+                heapq.heappop(self._deadlines)
+            return self._deadlines[0] if self._deadlines else None
+
+    def expire_due(self, now: float) -> list:
+        """Move the active coupons that expired before ``now`` to the expired set and return them"""
+        with self._lock:
+            due = []
+            while self._deadlines and self._deadlines[0] < now:
+                ts = heapq.heappop(self._deadlines)
+                # A moment whose bucket emptied and was refilled is on the heap twice
+                if ts in self._by_expiry and (not due or due[-1] != ts):
+                    due.append(ts)
+            cpns = [self.coupons[cid] for ts in due for cid in self._by_expiry[ts]]
+            if not cpns:
+                return []
+            try:
+                self._append({"op": "expire", "ids": [c.coupon_id for c in cpns]})
+            except OSError:
+                # Nothing was moved, so keep the deadlines for the next sweep
+                for ts in due:
+                    heapq.heappush(self._deadlines, ts)
+                raise
+        return cpns
+
+    def get(self, cid: str) -> Optional[Coupon]:
+        """Return an active coupon by id"""
+        return self.coupons.get(cid)
+
+    def find(self, cid: str) -> Optional[Coupon]:
+        """Return a coupon by id whether it is active, expired or used in the hot window"""
+        return self.coupons.get(cid) or self.expired.get(cid) or self.used.get(cid)
+
+    def has_active(self) -> bool:
+        return bool(self.coupons)
+
+    def active_by_recipient(self, rcpt: str) -> list:
+        return [self.coupons[cid] for _, cid in self._active_by_rcpt.get(rcpt, ())]
+
+    def active_count(self, rcpt: str) -> int:
+        return len(self._active_by_rcpt.get(rcpt, ()))
+
+    def holders(self, rcpt: str) -> set:
+        """Return the users holding active coupons of a recipient"""
+        return {c.user_id for c in self.active_by_recipient(rcpt) if c.user_id is not None}
+
+    def active_page(self, rcpt: str, limit: int, cursor: Optional[Cursor] = None,
+                    back: bool = False) -> list:
+        """Return a page of a recipient's active coupons, oldest first"""
+        keys = self._active_by_rcpt.get(rcpt)
+        if keys is None:
+            return []
+        return [self.coupons[cid] for _, cid in keys.page(limit, cursor, back)]
+
+    def used_by_recipient(self, rcpt: str, limit: Optional[int] = None) -> list:
+        """Return a recipient's used coupons in the hot window, oldest first, optionally only the last ``limit``"""
+        keys = self._used_by_rcpt.get(rcpt, SortedIndex()).keys
+        if limit is not None:
+            keys = keys[-limit:] if limit else []
+        return [self.used[cid] for _, cid in keys]
+
+    def used_page(self, limit: int, cursor: Optional[Cursor] = None, back: bool = False) -> list:
+        """Return a page of the redemption history, newest first.
+
+        Pages are served from the hot window and continue into the archive
+        once they reach past it.
+        """
+        hot = self._used_order
+        if back:
+            # The keys right after the cursor may still be archived
+            oldest = hot.keys[0] if hot else None
+            older = [] if oldest is not None and cursor >= oldest else self.archive.page(limit, cursor, back)
+            newer = hot.page(limit - len(older), cursor, back, desc=True) if len(older) < limit else []
+            return [self.used[cid] for _, cid in newer] + older
+
+        cpns = [self.used[cid] for _, cid in hot.page(limit, cursor, back, desc=True)]
+        if len(cpns) < limit:
+            edge = (cpns[-1].redeemed, cpns[-1].coupon_id) if cpns else cursor
+            cpns += self.archive.page(limit - len(cpns), edge)
+        return cpns
+
+    def by_user(self, uid: int) -> list:
+        return [self.coupons[cid] for cid in self._active_by_user.get(uid, ())]
+
+    def used_by_user(self, uid: int) -> list:
+        """Return a user's used coupons in the hot window"""
+        return [self.used[cid] for cid in self._used_by_user.get(uid, ())]
+
+    def expired_by_user(self, uid: int) -> list:
+        return [self.expired[cid] for cid in self._expired_by_user.get(uid, ())]
+
+    def used_count(self, rcpt: str) -> int:
+        return self.cntrs.get(rcpt, 0)
+
+    def iter_active(self) -> Iterator[Coupon]:
+        return iter(list(self.coupons.values()))
+
+    def iter_expired(self) -> Iterator[Coupon]:
+        return iter(list(self.expired.values()))
+
+    def iter_used(self) -> Iterator[Coupon]:
+        """Stream archived, then hot used coupons"""
+        hot = list(self.used.values())
+        for cpn in self.archive.iter_used():
+            if cpn.coupon_id not in self.used:
+                yield cpn
+        yield from hot
+
+    def _start_compaction(self):
+        """Rotate the journal and write snapshots in a background thread (lock held)"""
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._drop_archived()
+        self._jf.close()
+        if os.path.exists(self._rotated_file):
+            # A previous compaction never finished, carry its records forward
+            with open(self._rotated_file, 'ab') as dst, open(self.journal_file, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self._rotated_file)
+        self._jf = open(self.journal_file, 'a', encoding='utf-8')
+        self._pending = 0
+
+        # Redemptions before the hot window leave the used snapshot for the archive
+        keys = self._used_order.keys
+        cold = [self.used[cid] for _, cid in keys[:bisect.bisect_left(keys, (hot_cutoff(time.time(), self.hot_days),))]]
+        used = dict(self.used)
+        for cpn in cold:
+            del used[cpn.coupon_id]
+
+        state = (dict(self.coupons), used, dict(self.expired), dict(self.cntrs), dict(self.meta), cold)
+        self._compactor = threading.Thread(target=self._write_snapshots, args=state, daemon=True)
+        self._compactor.start()
+
+    def _write_snapshots(self, coupons: dict, used: dict, expired: dict, cntrs: dict, meta: dict, cold: list):
+        """Archive cold redemptions, write snapshots, then drop the rotated journal they now cover"""
+        try:
+            if cold:
+                self.archive.write(cold)
+                self._archived.append(cold)
+            dump_json(self.coupons_file, {cid: c.to_dict() for cid, c in coupons.items()})
+            dump_json(self.used_file, {cid: c.to_dict() for cid, c in used.items()})
+            dump_json(self.expired_file, {cid: c.to_dict() for cid, c in expired.items()})
+            dump_json(self.cntr_file, cntrs)
+            dump_json(self.meta_file, meta)
+            os.remove(self._rotated_file)
+            logging.info(
+                f"Journal compacted: {len(coupons)} active, {len(used)} used, "
+                f"{len(expired)} expired, {len(cold)} archived"
+            )
+        except OSError as e:
+            logging.error(f"Journal compaction failed: {str(e)}")
+
+    def compact(self):
+        """Synchronously fold the whole journal into the snapshots"""
+        if self.read_only:
+            return
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            self._start_compaction()
+            compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            self._drop_archived()
+
+    def close(self):
+        """Compact and close the journal, then release the writer lock"""
+        if self.read_only:
+            return
+        self.compact()
+        with self._lock:
+            self._jf.close()
+        self._lockf.close()
+
+class LazyStore:
+    """Proxy that opens the configured store on first use.
+
+    Reading the snapshots and replaying the journal is then kept off the
+    startup path, so the bot can start polling first. ``load`` may be called
+    from a warm-up thread; concurrent callers wait for the same load.
+    """
+
+    def __init__(self, factory=None):
+        self._factory = factory or open_store
+        self._store = None
+        self._lock = threading.Lock()
+        self.load_time: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._store is not None
+
+    def load(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    started = time.perf_counter()
+                    store = self._factory()
+                    self.load_time = time.perf_counter() - started
+                    self._store = store
+        return self._store
+
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+def open_store(read_only: bool = False):
+    """Create the store backend selected by the STORE_BACKEND env var.
+
+    ``read_only`` opens the JSON store without writing it; SQLite handles
+    readers next to the bot itself.
+    """
+    if STORE_BACKEND == "json":
+        return JournalStore(read_only=read_only)
+    if STORE_BACKEND == "sqlite":
+        from sqlite_store import SqliteStore
+        return SqliteStore()
+    raise ValueError(f"Unknown STORE_BACKEND {STORE_BACKEND!r}, expected 'json' or 'sqlite'")
@@ -0,0 +1,148 @@
+"""Stress check of exactly-once coupon redemption.
+
+    python stress.py                              # both backends
+    python stress.py --backend json --threads 32
+    python stress.py --backend sqlite --processes 8 --coupons 1000
+
+Every worker tries to redeem every coupon of a fresh store, each in its
+own random order and ``--batch`` codes per ``redeem_many`` call. The JSON
+store is shared by ``--threads`` threads of this process; the SQLite
+database by ``--processes`` processes with ``--threads`` threads each, as
+several bot workers would share it. The run passes when each coupon got
+exactly one REDEEMED, the recipient counter equals the number of coupons,
+and a store opened afresh on the same files agrees. It exits with status 1
+otherwise.
+"""
+import os
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+
+os.environ.setdefault("COUPON_SECRET", "stress")
+
+import codes
+from records import REDEEMED, Coupon
+
+RECIPIENT = "stress"
+
+def seed(store, count: int) -> list:
+    now = int(time.time())
+    expiry = now + 86400
+    start = store.reserve_serials(count)
+    cpns = [Coupon(codes.mint(start + i, expiry), RECIPIENT, expiry, now) for i in range(count)]
+    store.add(cpns)
+    return [c.coupon_id for c in cpns]
+
+def hammer(store, cids: list, threads: int, batch: int, salt: int) -> list:
+    """Redeem all ``cids`` from ``threads`` threads at once, returning the ids each REDEEMED was for"""
+    won = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def worker(n: int):
+        order = list(cids)
+        random.Random(salt * 1000 + n).shuffle(order)
+        mine = []
+        start.wait()
+        for i in range(0, len(order), batch):
+            part = order[i:i + batch]
+            for cid, res in zip(part, store.redeem_many(part, int(time.time()))):
+                if res.status == REDEEMED:
+                    mine.append(cid)
+        with lock:
+            won.extend(mine)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return won
+
+def sqlite_worker(path: str, cids: list, threads: int, batch: int, salt: int) -> list:
+    from sqlite_store import SqliteStore
+    store = SqliteStore(path)
+    try:
+        return hammer(store, cids, threads, batch, salt)
+    finally:
+        store.close()
+
+def check(backend: str, cids: list, won: list, reopen, elapsed: float) -> dict:
+    wins = Counter(won)
+    store = reopen()
+    try:
+        counter = store.used_count(RECIPIENT)
+        left = sum(1 for cid in cids if store.get(cid) is not None)
+    finally:
+        store.close()
+    out = {
+        "backend": backend,
+        "coupons": len(cids),
+        "redeemed": len(won),
+        "double": sum(1 for n in wins.values() if n > 1),
+        "missed": sum(1 for cid in cids if cid not in wins),
+        "counter": counter,
+        "still_active": left,
+        "seconds": round(elapsed, 3)
+    }
+    out["ok"] = out["redeemed"] == len(cids) and not out["double"] and counter == len(cids) and not left
+    return out
+
+def run_json(args) -> dict:
+    from store import JournalStore
+    with tempfile.TemporaryDirectory(prefix="stress-") as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            # Compacting now and then puts the snapshot thread in the race too
+            store = JournalStore(compact_every=50)
+            cids = seed(store, args.coupons)
+            started = time.perf_counter()
+            won = hammer(store, cids, args.threads, args.batch, 0)
+            elapsed = time.perf_counter() - started
+            store.close()
+            return check("json", cids, won, JournalStore, elapsed)
+        finally:
+            os.chdir(cwd)
+
+def run_sqlite(args) -> dict:
+    from sqlite_store import SqliteStore
+    with tempfile.TemporaryDirectory(prefix="stress-") as path:
+        db = os.path.join(path, "coupons.db")
+        cwd = os.getcwd()
+        # No JSON snapshots there to migrate from
+        os.chdir(path)
+        try:
+            store = SqliteStore(db)
+            cids = seed(store, args.coupons)
+            store.close()
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(args.processes) as pool:
+                started = time.perf_counter()
+                parts = pool.starmap(sqlite_worker, [(db, cids, args.threads, args.batch, n + 1)
+                                                     for n in range(args.processes)])
+                elapsed = time.perf_counter() - started
+            return check("sqlite", cids, [cid for part in parts for cid in part], lambda: SqliteStore(db), elapsed)
+        finally:
+            os.chdir(cwd)
+
+def main(args):
+    runs = {"json": [run_json], "sqlite": [run_sqlite], "both": [run_json, run_sqlite]}[args.backend]
+    results = [run(args) for run in runs]
+    print(json.dumps(results, indent=2))
+    if not all(r["ok"] for r in results):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("json", "sqlite", "both"), default="both")
+    parser.add_argument("--coupons", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=16, help="threads per process")
+    parser.add_argument("--processes", type=int, default=4, help="processes sharing the SQLite database")
+    parser.add_argument("--batch", type=int, default=1, help="codes per redeem_many call")
+    main(parser.parse_args())
@@ -0,0 +1,63 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+# Longest sleep between sweeps, so coupons created meanwhile by another
+# worker process are still swept on time
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "60"))
+
+class ExpirySweeper:
+    """Background task moving coupons out of the active set as they expire.
+
+    It sleeps until the earliest expiry among active coupons (at most
+    ``interval`` seconds) and then has the store move every coupon that is
+    due. The store finds those through its expiry index, so a sweep costs as
+    much as the number of coupons expiring, not the size of the store.
+    ``on_expired`` is awaited with the coupons of each non-empty sweep.
+    A lazily opened store is left alone until something else loads it.
+    Like the handlers, the sweep calls the store on the event loop, since
+    the JSON store's readers take no lock.
+    """
+
+    def __init__(self, store, on_expired: Optional[Callable[[list], Awaitable]] = None,
+                 interval: float = SWEEP_INTERVAL):
+        self.store = store
+        self.on_expired = on_expired
+        self.interval = interval
+        self.swept = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def sweep(self, now: float) -> list:
+        """Expire the coupons due at ``now``"""
+        cpns = self.store.expire_due(now)
+        if cpns:
+            self.swept += len(cpns)
+            logging.info(f"Expired {len(cpns)} coupons")
+            if self.on_expired is not None:
+                await self.on_expired(cpns)
+        return cpns
+
+    async def _run(self):
+        while True:
+            if not getattr(self.store, "loaded", True):
+                await asyncio.sleep(self.interval)
+                continue
+            try:
+                await self.sweep(time.time())
+                deadline = self.store.next_expiry()
+            except Exception as e:
+                logging.error(f"Expiry sweep failed: {str(e)}")
+                deadline = None
+            # A coupon counts as expired once its expiry lies in the past
+            delay = self.interval if deadline is None else min(self.interval, max(0, deadline - time.time()) + 1)
+            await asyncio.sleep(delay)
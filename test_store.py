@@ -0,0 +1,69 @@
+"""Regression tests of the coupon stores.
+
+    python -m unittest test_store
+"""
+import os
+import time
+import tempfile
+import unittest
+
+from archive import UsedArchive
+from records import ALREADY_USED, Coupon
+from store import JournalStore
+
+DAY = 86400
+
+class StoreTestCase(unittest.TestCase):
+    """Runs every test in its own temporary directory, where the stores keep their files"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix="test-store-")
+        self._cwd = os.getcwd()
+        os.chdir(self._tmp.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+class ExpiryTest(StoreTestCase):
+
+    def test_refilled_expiry_moment_expires_once(self):
+        now = int(time.time())
+        expiry = now + DAY
+        store = JournalStore()
+        try:
+            store.add([Coupon("PROMO-AAAAAA", "r", expiry, now)])
+            store.redeem("PROMO-AAAAAA", now)
+            store.add([Coupon("PROMO-BBBBBB", "r", expiry, now)])
+            self.assertEqual([c.coupon_id for c in store.expire_due(expiry + 1)], ["PROMO-BBBBBB"])
+            self.assertEqual(store.expire_due(expiry + 1), [])
+            self.assertIsNone(store.next_expiry())
+        finally:
+            store.close()
+
+class SqliteMigrationTest(StoreTestCase):
+
+    def test_archived_redemptions_are_migrated(self):
+        from sqlite_store import SqliteStore
+
+        now = int(time.time())
+        created = now - 400 * DAY
+        cpns = [Coupon(f"PROMO-{i:06d}", "r", now + 30 * DAY, created) for i in range(6)]
+        src = JournalStore()
+        src.add(cpns)
+        src.redeem_many([c.coupon_id for c in cpns[:3]], created + DAY)
+        src.redeem_many([c.coupon_id for c in cpns[3:5]], now)
+        src.close()
+        self.assertTrue(UsedArchive().months())
+
+        db = SqliteStore("coupons.db")
+        try:
+            self.assertEqual([c.coupon_id for c in db.iter_used()], [c.coupon_id for c in cpns[:5]])
+            self.assertEqual(db.used_count("r"), 5)
+            self.assertEqual([c.coupon_id for c in db.iter_active()], [cpns[5].coupon_id])
+            self.assertEqual(db.redeem(cpns[0].coupon_id, now).status, ALREADY_USED)
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    unittest.main()
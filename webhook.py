@@ -0,0 +1,174 @@
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from aiohttp import web
+
+import metrics
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_QUEUE = int(os.getenv("UPDATE_QUEUE", "1000"))
+ENQUEUE_TIMEOUT = float(os.getenv("ENQUEUE_TIMEOUT", "5"))
+
+# Handling latencies kept for the percentiles of the stats endpoint
+LATENCY_WINDOW = 10000
+
+def chat_key(update: dict) -> int:
+    """Return the chat an update belongs to, falling back to the sender or the update id"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return update.get("update_id", 0)
+
+def is_album_part(update: dict) -> bool:
+    msg = update.get("message")
+    return bool(msg and msg.get("media_group_id"))
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+class UpdatePool:
+    """Bounded pool that handles each chat's updates in arrival order.
+
+    Every chat with pending updates has its own queue and one task draining
+    it, so updates of one chat never overtake each other, while a slow
+    handler (a large PDF batch, say) only holds up its own chat. At most
+    ``concurrency`` updates are handled at once across all chats. At most
+    ``capacity`` updates are held in total: when the pool is full, ``submit``
+    waits up to ``timeout`` and then refuses the update. Album photos are
+    started without waiting for the previous one, since the album handler
+    collects them itself.
+    """
+
+    def __init__(self, handle: Callable[[dict], Awaitable], concurrency: int = UPDATE_CONCURRENCY,
+                 capacity: int = UPDATE_QUEUE, timeout: float = ENQUEUE_TIMEOUT):
+        self.handle = handle
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._slots = asyncio.Semaphore(capacity)
+        self._running = asyncio.Semaphore(concurrency)
+        # Chat -> updates waiting behind the one being handled
+        self._chats = {}
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, update: dict) -> bool:
+        """Queue an update, returning False if the pool stayed full for ``timeout``"""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        chat = chat_key(update)
+        queue = self._chats.get(chat)
+        if queue is None:
+            queue = self._chats[chat] = deque()
+            self._spawn(self._drain(chat, queue))
+        queue.append((time.perf_counter(), update))
+        return True
+
+    async def _run(self, queued: float, update: dict):
+        try:
+            async with self._running:
+                metrics.QUEUE_WAIT.observe(time.perf_counter() - queued)
+                try:
+                    await self.handle(update)
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Update {update.get('update_id')} failed: {str(e)}")
+            self.processed += 1
+            self.latencies.append(time.perf_counter() - queued)
+        finally:
+            self._slots.release()
+
+    async def _drain(self, chat: int, queue: deque):
+        while queue:
+            queued, update = queue.popleft()
+            if is_album_part(update):
+                self._spawn(self._run(queued, update))
+            else:
+                await self._run(queued, update)
+        del self._chats[chat]
+
+    async def stop(self):
+        """Finish the queued updates"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def report(self) -> dict:
+        lat = sorted(self.latencies)
+        return {
+            "queued": sum(len(q) for q in self._chats.values()),
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "p50_ms": round(percentile(lat, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(lat, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(lat, 0.99) * 1000, 2)
+        }
+
+def create_app(pool: UpdatePool, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> web.Application:
+    """Build the aiohttp app receiving Telegram webhook updates"""
+
+    async def receive(request: web.Request) -> web.Response:
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        update = await request.json()
+        if not await pool.submit(update):
+            # Telegram redelivers updates the webhook did not accept
+            return web.Response(status=503, text="queue full")
+        return web.Response()
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(pool.report())
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    app.router.add_get(f"{path}/stats", stats)
+    return app
+
+async def serve(dp, bot):
+    """Run the dispatcher behind a local webhook server until cancelled"""
+    pool = UpdatePool(lambda update: dp.feed_raw_update(bot, update))
+    runner = web.AppRunner(create_app(pool), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+                 f"handling up to {pool.concurrency} updates at once")
+
+    await dp.emit_startup(bot=bot)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
+        await dp.emit_shutdown(bot=bot)
+        await dp.storage.close()
+        logging.info(f"Webhook stopped: {pool.report()}")
@@ -0,0 +1,210 @@
+"""Run several bot processes behind one webhook.
+
+    BOT_WORKERS=4 WEBHOOK_URL=https://example.com/webhook python workers.py
+
+Starts ``BOT_WORKERS`` copies of bot.py in webhook mode on local ports
+from ``WORKER_BASE_PORT`` and listens on ``WEBHOOK_PORT`` itself. Every
+update is forwarded to the worker its chat hashes to, so one chat's updates
+are still handled in order by one process, while the coupon store and the
+FSM dialog states live in a SQLite database all workers share. Set
+``WORKER_URLS`` to comma-separated webhook URLs of workers running on other
+hosts to only route to them (they need the database on a shared volume).
+"""
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+from collections import defaultdict
+
+from aiohttp import ClientConnectionError, ClientSession, ClientTimeout, web
+from dotenv import load_dotenv
+
+from metrics import METRICS_PORT
+from webhook import WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL, chat_key
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "2")))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8090"))
+WORKER_URLS = [u.strip() for u in os.getenv("WORKER_URLS", "").split(",") if u.strip()]
+RESTART_DELAY = 1
+STOP_TIMEOUT = 30
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def worker_env(n: int, port: int) -> dict:
+    """Environment of a local worker: webhook mode on its own port, shared SQLite state"""
+    from sender import CHAT_RATE, GROUP_RATE, SEND_RATE
+
+    env = dict(os.environ)
+    if METRICS_PORT:
+        # Every worker serves its own metrics, on consecutive ports
+        env["METRICS_PORT"] = str(METRICS_PORT + n)
+    # Terminals need one address: run pos.py next to the workers instead
+    env["POS_PORT"] = "0"
+    env.pop("WEBHOOK_URL", None)
+    env.update(
+        UPDATE_MODE="webhook",
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(port),
+        WEBHOOK_PATH=WEBHOOK_PATH,
+        STORE_BACKEND="sqlite",
+        FSM_STORAGE="sqlite",
+        # Every worker paces its own sends, so together they keep to the configured rates
+        SEND_RATE=str(SEND_RATE / BOT_WORKERS),
+        CHAT_RATE=str(CHAT_RATE / BOT_WORKERS),
+        GROUP_RATE=str(GROUP_RATE / BOT_WORKERS)
+    )
+    return env
+
+class Router:
+    """Forwards each update to the worker of its chat, one update per chat at a time.
+
+    Waiting for the worker to accept an update before forwarding the next
+    one of the same chat keeps the chat's updates in order. A worker that
+    refuses an update or is down gets a 503 relayed back, so Telegram
+    redelivers it later.
+    """
+
+    def __init__(self, urls: list):
+        self.urls = urls
+        self.forwarded = 0
+        self.refused = 0
+        self._http = None
+        self._locks = {}
+        self._waiting = defaultdict(int)
+
+    async def start(self):
+        self._http = ClientSession(timeout=ClientTimeout(total=60))
+
+    async def close(self):
+        if self._http:
+            await self._http.close()
+
+    async def forward(self, chat: int, body: bytes) -> int:
+        url = self.urls[chat % len(self.urls)]
+        headers = {"Content-Type": "application/json"}
+        if WEBHOOK_SECRET:
+            headers[SECRET_HEADER] = WEBHOOK_SECRET
+
+        lock = self._locks.setdefault(chat, asyncio.Lock())
+        self._waiting[chat] += 1
+        try:
+            async with lock:
+                try:
+                    async with self._http.post(url, data=body, headers=headers) as resp:
+                        status = resp.status
+                except (ClientConnectionError, asyncio.TimeoutError):
+                    status = 503
+        finally:
+            self._waiting[chat] -= 1
+            if not self._waiting[chat]:
+                del self._waiting[chat]
+                del self._locks[chat]
+
+        if status == 200:
+            self.forwarded += 1
+        else:
+            self.refused += 1
+        return status
+
+    def report(self) -> dict:
+        return {"workers": len(self.urls), "forwarded": self.forwarded, "refused": self.refused}
+
+def create_app(router: Router) -> web.Application:
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        status = await router.forward(chat_key(json.loads(body)), body)
+        return web.Response(status=200 if status == 200 else 503)
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(router.report())
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.router.add_get(f"{WEBHOOK_PATH}/stats", stats)
+    return app
+
+async def supervise(n: int, port: int, stopping: asyncio.Event):
+    """Run bot.py as worker ``n``, restarting it if it exits before shutdown"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(here, "bot.py"), cwd=here, env=worker_env(n, port),
+            # Keep Ctrl+C in the terminal from reaching the workers before the router stops them
+            start_new_session=True
+        )
+        logging.info(f"Worker {n} started on port {port} (pid {proc.pid})")
+        waiter = asyncio.create_task(proc.wait())
+        stopper = asyncio.create_task(stopping.wait())
+        await asyncio.wait({waiter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+
+        if stopping.is_set():
+            if proc.returncode is None:
+                # Same as Ctrl+C: the worker finishes its queued updates first
+                proc.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(waiter, STOP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await waiter
+            logging.info(f"Worker {n} stopped")
+            return
+        stopper.cancel()
+        logging.error(f"Worker {n} exited with code {proc.returncode}, restarting")
+        await asyncio.sleep(RESTART_DELAY)
+
+async def register_webhook():
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    api_url = os.getenv("TELEGRAM_API_URL")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None
+    bot = Bot(token=os.getenv("BOT_TOKEN"), session=session)
+    try:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    finally:
+        await bot.session.close()
+
+async def main():
+    if os.getenv("STORE_BACKEND", "sqlite") != "sqlite":
+        raise SystemExit("Bot workers share their coupons through SQLite, set STORE_BACKEND=sqlite")
+    stopping = asyncio.Event()
+    supervisors = []
+    if WORKER_URLS:
+        urls = WORKER_URLS
+    else:
+        ports = [WORKER_BASE_PORT + i for i in range(BOT_WORKERS)]
+        urls = [f"http://127.0.0.1:{p}{WEBHOOK_PATH}" for p in ports]
+        supervisors = [asyncio.create_task(supervise(i, p, stopping)) for i, p in enumerate(ports)]
+
+    router = Router(urls)
+    await router.start()
+    runner = web.AppRunner(create_app(router), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Routing {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} to {len(urls)} workers")
+    if WEBHOOK_URL:
+        await register_webhook()
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        stopping.set()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        await router.close()
+        logging.info(f"Router stopped: {router.report()}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass